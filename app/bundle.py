@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+bundle.py
+
+Builds a slimmed-down Brython standard library bundle that only includes the
+modules that the widget, its supporting modules, and the puzzles actually
+import (plus whatever those modules import in turn). The bundle and a copy of
+brython.js are written under content-hashed filenames, and an asset manifest
+is written so that the server can refer to them (see asset_url in
+procedural.py).
+
+The widget itself (static/procedural.py) is also added to the bundle as the
+'procedural' module. Brython transpiles modules from the bundle once and
+keeps the resulting JavaScript in IndexedDB, so pages that import the widget
+from the bundle skip transpiling it on later visits. The bundle sets
+Brython's cache timestamp from its own content hash, so that cached
+JavaScript is discarded whenever procedural.py (or anything else in the
+bundle) changes.
+"""
+
+import os
+import re
+import sys
+import ast
+import json
+import glob
+import hashlib
+
+USAGE = """\
+bundle.py -h|--help
+bundle.py [-i|--include MODULE]...
+
+Scans static/procedural.py, static/python_modules/*.py, the categories file,
+and all puzzle files for imports, and writes a Brython stdlib bundle
+containing just those modules (and their dependencies) as
+static/brython/brython_modules.<hash>.js, plus a hashed copy of brython.js.
+The widget is included in the bundle as the 'procedural' module. The
+static/assets.json manifest maps the original filenames to the hashed ones
+(procedural.py maps to the bundle that contains it).
+
+Extra modules (e.g., ones that are only imported dynamically) can be added
+to the bundle using -i/--include.
+
+Run this from the app directory; it reads config.py (if present) for the
+CATEGORIES_FILE and PUZZLES_DIRECTORY settings.
+"""
+
+STATIC_DIR = "static"
+WIDGET = os.path.join(STATIC_DIR, "procedural.py")
+WIDGET_MODULE = "procedural"
+BRYTHON_DIR = os.path.join(STATIC_DIR, "brython")
+FULL_STDLIB = os.path.join(BRYTHON_DIR, "brython_stdlib.js")
+MANIFEST = os.path.join(STATIC_DIR, "assets.json")
+
+# Matches import statements at the start of a line of code
+IMPORT_RE = re.compile(
+  r"^\s*(?:from\s+([\w.]+)\s+import\b|import\s+([\w., ]+))",
+  re.MULTILINE
+)
+
+def imports_in_string(code):
+  """
+  Returns a set of module names imported by the given code string. Uses a
+  regular expression instead of parsing, because puzzle code blocks are
+  usually fragments which can't be parsed on their own.
+  """
+  result = set()
+  for match in IMPORT_RE.finditer(code):
+    if match.group(1):
+      result.add(match.group(1))
+    else:
+      for part in match.group(2).split(','):
+        name = part.strip().split(' ')[0]
+        if name:
+          result.add(name)
+  return result
+
+def imports_in_python_file(filename, strings=True):
+  """
+  Returns a set of module names imported by the given Python file, including
+  imports that appear inside string constants (e.g., the code of the default
+  puzzles in procedural.py) unless strings is False.
+  """
+  with open(filename, 'r') as fin:
+    tree = ast.parse(fin.read(), filename)
+
+  result = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      for alias in node.names:
+        result.add(alias.name)
+    elif isinstance(node, ast.ImportFrom):
+      if node.module and node.level == 0:
+        result.add(node.module)
+    elif (
+      strings
+  and isinstance(node, ast.Constant)
+  and isinstance(node.value, str)
+    ):
+      result |= imports_in_string(node.value)
+  return result
+
+def imports_in_json(obj):
+  """
+  Returns a set of module names imported by any string inside the given
+  JSON-derived object (puzzle code, pre-exec code, tests, etc.).
+  """
+  result = set()
+  stack = [obj]
+  while stack:
+    here = stack.pop()
+    if isinstance(here, str):
+      result |= imports_in_string(here)
+    elif isinstance(here, list):
+      stack.extend(here)
+    elif isinstance(here, dict):
+      stack.extend(here.values())
+  return result
+
+def imports_in_json_file(filename):
+  """
+  Returns a set of module names imported by code in the given JSON file.
+  Logs a message and returns an empty set if the file can't be parsed.
+  """
+  try:
+    with open(filename, 'r') as fin:
+      obj = json.load(fin)
+  except Exception as e:
+    print(
+      "Warning: skipping '{}' ({})".format(filename, e),
+      file=sys.stderr
+    )
+    return set()
+  return imports_in_json(obj)
+
+def load_config():
+  """
+  Returns a dictionary of settings from config.py, or an empty dictionary if
+  there is no config.py.
+  """
+  result = {}
+  if os.path.exists("config.py"):
+    with open("config.py", 'r') as fin:
+      exec(fin.read(), result)
+  return result
+
+def read_vfs(filename):
+  """
+  Reads a Brython stdlib bundle and returns a (prefix, vfs, suffix) tuple,
+  where vfs is a dictionary mapping module names to [extension, source,
+  imports, ...] lists, and prefix/suffix are the JavaScript around it.
+  """
+  with open(filename, 'r') as fin:
+    text = fin.read()
+  start = text.index('{')
+  end = text.rindex('}') + 1
+  return text[:start], json.loads(text[start:end]), text[end:]
+
+def module_closure(roots, vfs):
+  """
+  Returns the set of module names in the given VFS that are needed to import
+  each of the given root modules, including parent packages and everything
+  that those modules import. Names that aren't in the VFS (built-in modules,
+  modules from python_modules, optional imports) are ignored.
+  """
+  result = set()
+  stack = list(roots)
+  while stack:
+    name = stack.pop()
+    # Importing a.b.c first imports a and a.b
+    parts = name.split('.')
+    for i in range(1, len(parts) + 1):
+      sub = '.'.join(parts[:i])
+      if sub in vfs and sub not in result:
+        result.add(sub)
+        entry = vfs[sub]
+        if len(entry) > 2:
+          stack.extend(entry[2])
+  return result
+
+def write_hashed(directory, stem, content):
+  """
+  Writes the given content to <directory>/<stem>.<hash>.js and returns that
+  filename.
+  """
+  digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+  filename = os.path.join(directory, "{}.{}.js".format(stem, digest))
+  with open(filename, 'w') as fout:
+    fout.write(content)
+  return filename
+
+def static_name(filename):
+  """
+  Converts a filename to the form used for url_for('static', ...).
+  """
+  return os.path.relpath(filename, STATIC_DIR).replace(os.sep, '/')
+
+def update_manifest(entries):
+  """
+  Adds the given original-name -> hashed-name entries to the asset manifest,
+  keeping any other entries that are already there.
+  """
+  manifest = {}
+  if os.path.exists(MANIFEST):
+    with open(MANIFEST, 'r') as fin:
+      manifest = json.load(fin)
+  manifest.update(entries)
+  with open(MANIFEST, 'w') as fout:
+    json.dump(manifest, fout, indent=2, separators=(',', ': '), sort_keys=True)
+
+def main(include):
+  """
+  Scans for imports and writes the bundle, hashed brython.js, and manifest.
+  """
+  config = load_config()
+
+  roots = set(include)
+  roots |= imports_in_python_file(WIDGET)
+  for f in glob.glob(os.path.join(STATIC_DIR, "python_modules", "*.py")):
+    roots |= imports_in_python_file(f)
+
+  roots |= imports_in_json_file(
+    config.get("CATEGORIES_FILE", "categories.json")
+  )
+  pdir = config.get("PUZZLES_DIRECTORY", "puzzles")
+  for f in glob.glob(os.path.join(pdir, "**", "*.json"), recursive=True):
+    roots |= imports_in_json_file(f)
+
+  prefix, vfs, suffix = read_vfs(FULL_STDLIB)
+  keep = module_closure(roots, vfs)
+  slim = { name: vfs[name] for name in sorted(keep) }
+
+  with open(WIDGET, 'r') as fin:
+    slim[WIDGET_MODULE] = [
+      ".py",
+      fin.read(),
+      sorted(imports_in_python_file(WIDGET, strings=False))
+    ]
+
+  # Brython only re-uses JavaScript cached in IndexedDB if it was stored
+  # under the current timestamp, so derive one from the bundle contents:
+  vfs_json = json.dumps(slim)
+  digest = hashlib.sha256(vfs_json.encode("utf-8")).hexdigest()
+  timestamp = int(digest[:12], 16)
+  bundle = write_hashed(
+    BRYTHON_DIR,
+    "brython_modules",
+    (
+      prefix
+    + vfs_json
+    + suffix
+    + "__BRYTHON__.timestamp = {};\n".format(timestamp)
+    )
+  )
+  with open(os.path.join(BRYTHON_DIR, "brython.js"), 'r') as fin:
+    core = write_hashed(BRYTHON_DIR, "brython", fin.read())
+
+  update_manifest({
+    "brython/brython_stdlib.js": static_name(bundle),
+    "brython/brython.js": static_name(core),
+    "procedural.py": static_name(bundle),
+  })
+
+  print(
+    "Bundled {} of {} stdlib modules plus the widget into '{}' ({} bytes)."
+    .format(
+      len(keep),
+      len(vfs),
+      bundle,
+      os.path.getsize(bundle)
+    )
+  )
+  print("Modules: {}".format(', '.join(sorted(keep))))
+
+if __name__ == "__main__":
+  if '-h' in sys.argv or '--help' in sys.argv:
+    print(USAGE)
+    exit()
+
+  include = []
+  args = sys.argv[1:]
+  while args:
+    arg = args.pop(0)
+    if arg in ('-i', '--include') and args:
+      include.append(args.pop(0))
+    else:
+      print(USAGE, file=sys.stderr)
+      exit(1)
+
+  main(include)
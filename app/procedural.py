@@ -14,8 +14,14 @@ import werkzeug
 import os
 import sys
 import json
+import time
+import socket
+import hashlib
+import threading
 import traceback
 import datetime
+import urllib.parse
+import urllib.request
 
 #------------------#
 # Global Variables #
@@ -49,6 +55,27 @@ CREATE TABLE solutions (
 # Default permissions
 DEFAULT_PERMISSIONS = { "admins": [], "puzzles": {} }
 
+# Cache-Control header for static files with content-hashed names
+HASHED_ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Asset manifest (see bundle.py) as loaded from disk, plus its modification
+# time, so that we only re-read it when it changes.
+ASSET_MANIFEST = {}
+ASSET_MANIFEST_MTIME = None
+
+# Puzzle IDs of the form pool-GENRE-SLOT are assigned to each user from the
+# generated puzzle pool for GENRE (see Puzzle Pools below).
+POOL_PREFIX = "pool"
+
+# Pool files and assignment logs as read so far, per genre (see
+# read_new_lines), so that each request only reads what's been appended since
+# the last one. POOL_LOCK guards these and REFILLING, the set of genres with a
+# refill in progress.
+POOLS = {}
+ASSIGNMENTS = {}
+REFILLING = set()
+POOL_LOCK = threading.Lock()
+
 #-------------------------#
 # Setup and Configuration #
 #-------------------------#
@@ -109,6 +136,72 @@ def admin_only(f):
   wrapped.__name__ = f.__name__
   return wrapped
 
+#---------------#
+# Static Assets #
+#---------------#
+
+def get_asset_manifest():
+  """
+  Returns the asset manifest written by bundle.py, which maps static
+  filenames to content-hashed versions of those files. Re-reads the manifest
+  file when it has changed, and returns an empty dictionary if there isn't
+  one.
+  """
+  global ASSET_MANIFEST, ASSET_MANIFEST_MTIME
+  mf = app.config.get(
+    "ASSET_MANIFEST",
+    os.path.join(app.static_folder, "assets.json")
+  )
+  try:
+    mtime = os.path.getmtime(mf)
+  except OSError:
+    ASSET_MANIFEST = {}
+    ASSET_MANIFEST_MTIME = None
+    return ASSET_MANIFEST
+
+  if mtime != ASSET_MANIFEST_MTIME:
+    try:
+      with open(mf, 'r') as fin:
+        ASSET_MANIFEST = json.load(fin)
+      ASSET_MANIFEST_MTIME = mtime
+    except Exception as e:
+      print("Error loading asset manifest '{}': {}".format(mf, e))
+      ASSET_MANIFEST = {}
+
+  return ASSET_MANIFEST
+
+@app.template_global()
+def asset_url(filename):
+  """
+  Works like url_for('static', filename=filename), but uses the
+  content-hashed version of the file if bundle.py has built one.
+  """
+  return flask.url_for(
+    'static',
+    filename=get_asset_manifest().get(filename, filename)
+  )
+
+@app.template_global()
+def asset_bundled(filename):
+  """
+  Returns True if bundle.py has built a content-hashed version of the given
+  static file (for procedural.py, this means that the widget can be imported
+  from the Brython bundle instead of being loaded as a separate script).
+  """
+  return filename in get_asset_manifest()
+
+@app.after_request
+def cache_hashed_assets(response):
+  """
+  Lets browsers cache content-hashed static files indefinitely, since their
+  names change whenever their contents do.
+  """
+  if flask.request.endpoint == 'static':
+    filename = (flask.request.view_args or {}).get("filename")
+    if filename in get_asset_manifest().values():
+      response.headers["Cache-Control"] = HASHED_ASSET_CACHE_CONTROL
+  return response
+
 #---------------#
 # Server Routes #
 #---------------#
@@ -140,7 +233,9 @@ def route_categories():
 @app.route("/puzzle", methods=["GET", "POST"])
 def route_puzzle():
   """
-  This route returns JSON puzzles from the PUZZLES_DIRECTORY.
+  This route returns JSON puzzles from the PUZZLES_DIRECTORY, or for puzzle
+  IDs like pool-vars-1, the puzzle from that genre's pool that's assigned to
+  the current user (see pooled_puzzle).
   """
   puzzle_id = flask.request.form.get("id", None)
   if puzzle_id == None:
@@ -168,6 +263,15 @@ def route_puzzle():
     user = flask.session.get("CAS_USERNAME", None)
     if has_permission(puzzle_id, user):
       bits = puzzle_id.split('-')
+      if bits[0] == POOL_PREFIX and len(bits) == 3:
+        if user == None:
+          return ("You must be logged in to get puzzle '{}'.".format(
+            puzzle_id
+          ), 403)
+        puzzle = pooled_puzzle(bits[1], puzzle_id, user)
+        if puzzle == None:
+          return ("Puzzle pool '{}' is unavailable.".format(bits[1]), 503)
+        return puzzle
       pdir = app.config.get("PUZZLES_DIRECTORY", "puzzles")
       target = os.path.join(pdir, *bits) + ".json"
       if os.path.exists(target):
@@ -195,34 +299,96 @@ def route_solved():
   if "CAS_USERNAME" not in flask.session:
     return { "status": "invalid", "reason": "not logged in" }
 
+  return accept_submission(
+    flask.session["CAS_USERNAME"],
+    flask.request.form.get("puzzle", None),
+    flask.request.form.get("solution", None)
+  )
+
+@app.route("/solved_batch", methods=["POST"])
+@returnJSON
+def route_solved_batch():
+  """
+  POST route that records several solutions at once (see the submission queue
+  in static/procedural.py). The request must have a "submissions" field
+  containing a JSON list of objects, each with "id", "puzzle", and "solution"
+  keys, where "puzzle" and "solution" are JSON strings just like the fields
+  for /solved. The response has a "results" list with one object per
+  submission, holding its "id" plus the same "status" and "reason" keys that
+  /solved would return, and a "retry" key that's true if the failure might
+  not happen again.
+  """
+  if "CAS_USERNAME" not in flask.session:
+    return { "status": "invalid", "reason": "not logged in" }
+
+  try:
+    submissions = json.loads(flask.request.form.get("submissions", None))
+    if not isinstance(submissions, list):
+      raise ValueError("Submissions must be a list.")
+  except:
+    return { "status": "invalid", "reason": "invalid submissions" }
+
+  if len(submissions) > app.config.get("MAX_BATCH_SUBMISSIONS", 100):
+    return { "status": "invalid", "reason": "too many submissions" }
+
+  results = []
+  for sub in submissions:
+    if not isinstance(sub, dict):
+      results.append({ "status": "invalid", "reason": "invalid submission" })
+      continue
+    result = accept_submission(
+      flask.session["CAS_USERNAME"],
+      sub.get("puzzle", None),
+      sub.get("solution", None)
+    )
+    result["id"] = sub.get("id", None)
+    results.append(result)
+
+  return { "status": "valid", "results": results }
+
+def accept_submission(username, puzzle, solution):
+  """
+  Parses and records a solution submitted by the given user, where puzzle and
+  solution are JSON strings (or None if they're missing). Returns a response
+  object with a "status" key that's either "valid" or "invalid", and for
+  invalid submissions a "reason" and a "retry" key (true if the failure was
+  on our end).
+  """
   # Get puzzle object from request:
-  puzzle = flask.request.form.get("puzzle", None)
   if puzzle == None:
-    return { "status": "invalid", "reason": "no puzzle sent" }
+    return { "status": "invalid", "reason": "no puzzle sent", "retry": False }
 
   # Parse puzzle from JSON:
   try:
     puzzle = json.loads(puzzle)
   except:
-    return { "status": "invalid", "reason": "invalid puzzle" }
+    return { "status": "invalid", "reason": "invalid puzzle", "retry": False }
 
   # Get solution object from request:
-  solution = flask.request.form.get("solution", None)
   if solution == None:
-    return { "status": "invalid", "reason": "no solution sent" }
+    return {
+      "status": "invalid",
+      "reason": "no solution sent",
+      "retry": False
+    }
 
   # Parse solution as JSON:
   try:
     solution = json.loads(solution)
   except:
-    return { "status": "invalid", "reason": "invalid solution" }
+    return {
+      "status": "invalid",
+      "reason": "invalid solution",
+      "retry": False
+    }
 
   try:
-    result = record_solution(flask.session["CAS_USERNAME"], puzzle, solution)
+    result = record_solution(username, puzzle, solution)
     if result != True:
       return {
         "status": "invalid",
-        "reason": "failed to save solution"
+        "reason": "failed to save solution",
+        "retry": True
       }
   except Exception as e:
     if sys.version_info >= (3, 5):
@@ -233,13 +399,332 @@ def route_solved():
       traceback.print_exception(*sys.exc_info())
     return {
       "status": "invalid",
-      "reason": "failed to save solution (crashed)"
+      "reason": "failed to save solution (crashed)",
+      "retry": True
     }
 
   # TODO: Verify solutions at all?
 
   return { "status": "valid" }
 
+#--------------#
+# Puzzle Pools #
+#--------------#
+
+# Each genre's pool is a JSON Lines file named GENRE.jsonl in the
+# POOLS_DIRECTORY, in the same format that the generator writes (see
+# gen/run.lp), and is only ever appended to, so that a puzzle's line number
+# (its "entry") never changes. Which entry each user got for each pooled
+# puzzle ID is recorded in GENRE-assignments.jsonl next to it, so that
+# submissions can be regraded against the exact puzzle that was served.
+
+def pool_file(genre, suffix):
+  """
+  Returns the filename for a genre's pool (suffix ".jsonl") or assignment
+  log (suffix "-assignments.jsonl").
+  """
+  pd = app.config.get("POOLS_DIRECTORY", "pools")
+  return os.path.join(pd, genre + suffix)
+
+def read_new_lines(filename, cache):
+  """
+  Reads the complete lines that have been appended to the given JSON Lines
+  file since the last call with the same cache dictionary, whose "offset"
+  key holds the number of bytes read so far. Returns a list with one parsed
+  object per line (None for lines that aren't valid JSON, so that positions
+  still match line numbers), which is empty if the file doesn't exist.
+  """
+  try:
+    with open(filename, 'rb') as fin:
+      fin.seek(cache["offset"])
+      data = fin.read()
+  except OSError:
+    return []
+
+  end = data.rfind(b'\n') + 1 # leave any partial line for next time
+  cache["offset"] += end
+  result = []
+  for line in data[:end].split(b'\n')[:-1]:
+    try:
+      result.append(json.loads(line))
+    except ValueError:
+      print("Invalid line in '{}': {!r}".format(filename, line))
+      result.append(None)
+
+  return result
+
+def get_pool(genre):
+  """
+  Returns the list of puzzles in a genre's pool, reading any that have been
+  added since the last call. Call this while holding POOL_LOCK.
+  """
+  cache = POOLS.setdefault(genre, { "offset": 0, "puzzles": [] })
+  cache["puzzles"].extend(read_new_lines(pool_file(genre, ".jsonl"), cache))
+  return cache["puzzles"]
+
+def get_assignments(genre):
+  """
+  Returns a dictionary with a genre's assignments, reading any that have been
+  recorded since the last call: "by_slot" maps (username, puzzle ID) pairs
+  to assignment records (see pooled_puzzle), and "claimed" is the set of
+  pool entries that have been assigned to someone. If the same slot was
+  assigned twice (by two processes at once), the first record wins. Call
+  this while holding POOL_LOCK.
+  """
+  cache = ASSIGNMENTS.setdefault(
+    genre,
+    { "offset": 0, "by_slot": {}, "claimed": set() }
+  )
+  log = pool_file(genre, "-assignments.jsonl")
+  for record in read_new_lines(log, cache):
+    if record == None:
+      continue
+    slot = (record["user"], record["puzzle"])
+    if slot not in cache["by_slot"]:
+      cache["by_slot"][slot] = record
+      cache["claimed"].add(record["entry"])
+
+  return cache
+
+def pick_pool_entry(puzzles, claimed, user, puzzle_id):
+  """
+  Deterministically picks a pool entry for the given user and puzzle ID:
+  starts from a position given by hashing both, and moves forward to the
+  first entry that nobody has been assigned yet. While the pool is kept
+  mostly unclaimed (see start_refill) this only looks at a few entries. If
+  every entry has been claimed, students have to share, and the starting
+  entry is used.
+  """
+  digest = hashlib.sha256(
+    "{}\n{}".format(user, puzzle_id).encode("utf-8")
+  ).digest()
+  start = int.from_bytes(digest[:8], "big") % len(puzzles)
+  for i in range(len(puzzles)):
+    entry = (start + i) % len(puzzles)
+    if entry not in claimed and puzzles[entry] != None:
+      return entry
+
+  return start
+
+def record_assignment(genre, record):
+  """
+  Appends an assignment record to a genre's assignment log. Returns True if
+  it succeeds and False if it fails.
+  """
+  log = pool_file(genre, "-assignments.jsonl")
+  try:
+    with open(log, 'a') as fout:
+      fout.write(json.dumps(record) + '\n')
+  except Exception as e:
+    print("Failed to write assignment log '{}'.".format(log))
+    traceback.print_exception(*sys.exc_info())
+    return False
+
+  return True
+
+def pooled_puzzle(genre, puzzle_id, user):
+  """
+  Returns the puzzle from the given genre's pool that's assigned to the given
+  user for the given pooled puzzle ID (e.g., pool-vars-1), assigning and
+  recording one first if necessary (see pick_pool_entry). Returns None if the
+  pool is empty or the assignment couldn't be recorded. Starts a background
+  refill when the pool is running low on unclaimed puzzles.
+  """
+  with POOL_LOCK:
+    puzzles = get_pool(genre)
+    assignments = get_assignments(genre)
+    record = assignments["by_slot"].get((user, puzzle_id))
+    if record == None and len(puzzles) > 0:
+      entry = pick_pool_entry(
+        puzzles,
+        assignments["claimed"],
+        user,
+        puzzle_id
+      )
+      recorded = record_assignment(
+        genre,
+        {
+          "user": user,
+          "puzzle": puzzle_id,
+          "entry": entry,
+          "key": (puzzles[entry] or {}).get("key", None),
+          "timestamp": datetime.datetime.now().strftime(
+            "%Y-%m-%d_%H:%M:%S.%f"
+          ),
+        }
+      )
+      if recorded:
+        # Re-read the log in case another process assigned this slot first:
+        record = get_assignments(genre)["by_slot"].get((user, puzzle_id))
+    unclaimed = len(puzzles) - len(assignments["claimed"])
+
+  if unclaimed < app.config.get("POOL_LOW_WATER", 50):
+    start_refill(genre)
+
+  if record == None or record["entry"] >= len(puzzles):
+    return None
+  puzzle = puzzles[record["entry"]]
+  if puzzle == None:
+    return None
+
+  return {
+    "id": puzzle_id,
+    "name": "Generated {} Puzzle {}".format(
+      genre.capitalize(),
+      puzzle_id.split('-')[-1]
+    ),
+    "code": puzzle["code"].splitlines(),
+    "tests": puzzle["tests"],
+  }
+
+def start_refill(genre):
+  """
+  Starts refilling a genre's pool in a background thread (see refill_pool),
+  unless a refill is already in progress in this process.
+  """
+  with POOL_LOCK:
+    if genre in REFILLING:
+      return
+    REFILLING.add(genre)
+
+  threading.Thread(target=refill_pool, args=(genre,), daemon=True).start()
+
+def pool_lock_is_stale(lf):
+  """
+  Returns True if the given pool lock file was left behind by a refill that
+  will never finish: either it's older than POOL_LOCK_TIMEOUT seconds, or the
+  process that wrote it (on this host) is no longer running. Our own process
+  only gets here when none of its threads is refilling the pool, so a lock
+  with our PID is left over from an earlier process that had the same PID.
+  """
+  try:
+    created = os.path.getmtime(lf)
+    with open(lf, 'r') as fin:
+      owner = json.load(fin)
+  except FileNotFoundError:
+    return False # already removed; whoever retries first gets it
+  except (OSError, ValueError):
+    owner = {} # still being written, or unreadable: go by age alone
+
+  created = owner.get("time", created)
+  if time.time() - created > app.config.get("POOL_LOCK_TIMEOUT", 900):
+    return True
+
+  pid = owner.get("pid")
+  if pid == None or owner.get("host") != socket.gethostname():
+    return False
+  if pid == os.getpid():
+    return True
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return True
+  except OSError:
+    pass # exists, but belongs to someone else
+  return False
+
+def acquire_pool_lock(lf):
+  """
+  Creates the given pool lock file, recording our PID, host, and the time,
+  unless it already exists. A stale lock (see pool_lock_is_stale) is broken
+  first. Returns True if we got the lock and False otherwise.
+
+  Two processes that break the same stale lock at once might both end up
+  refilling the pool, but that only costs some duplicate work.
+  """
+  for attempt in range(2):
+    try:
+      fd = os.open(lf, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o660)
+    except FileExistsError:
+      if attempt > 0 or not pool_lock_is_stale(lf):
+        return False
+      print("Breaking stale lock file '{}'.".format(lf))
+      try:
+        os.remove(lf)
+      except FileNotFoundError:
+        pass
+      continue
+
+    with os.fdopen(fd, 'w') as fout:
+      json.dump(
+        {
+          "pid": os.getpid(),
+          "host": socket.gethostname(),
+          "time": time.time(),
+        },
+        fout
+      )
+    return True
+
+  return False
+
+def refill_pool(genre):
+  """
+  Asks the generator service (see gen/serve.py) at GENERATOR_URL for
+  POOL_REFILL_COUNT new puzzles for the given genre, and appends them to the
+  genre's pool file as they arrive, skipping any that are already in the
+  pool. POOL_PARAMETERS may give extra request parameters per genre (e.g.,
+  { "vars": { "lines": "4-6" } }). Uses a lock file so that only one process
+  refills a pool at once (see acquire_pool_lock); a lock left behind by a
+  process that died is broken the next time a refill is needed.
+  """
+  pf = pool_file(genre, ".jsonl")
+  lf = pf + ".lock"
+  try:
+    pd = os.path.dirname(pf)
+    if pd and not os.path.exists(pd):
+      os.mkdir(pd, 0o770)
+    if not acquire_pool_lock(lf):
+      with POOL_LOCK:
+        REFILLING.discard(genre)
+      return
+  except Exception as e:
+    print("Failed to lock puzzle pool '{}'.".format(pf))
+    traceback.print_exception(*sys.exc_info())
+    with POOL_LOCK:
+      REFILLING.discard(genre)
+    return
+
+  try:
+    with POOL_LOCK:
+      known = set(
+        puzzle.get("key", None)
+        for puzzle in get_pool(genre)
+        if puzzle != None
+      )
+    params = { "genre": genre }
+    params.update(app.config.get("POOL_PARAMETERS", {}).get(genre, {}))
+    params["count"] = app.config.get("POOL_REFILL_COUNT", 200)
+    url = "{}/puzzles?{}".format(
+      app.config.get("GENERATOR_URL", "http://127.0.0.1:8765"),
+      urllib.parse.urlencode(params)
+    )
+    added = 0
+    with urllib.request.urlopen(url, timeout=600) as response:
+      with open(pf, 'ab') as fout:
+        for line in response:
+          try:
+            key = json.loads(line).get("key", None)
+          except ValueError:
+            continue # a partial line if the service stopped early
+          if key in known:
+            continue
+          known.add(key)
+          fout.write(line.rstrip(b'\n') + b'\n')
+          fout.flush() # so requests can use new puzzles right away
+          added += 1
+    print("Added {} puzzles to pool '{}'.".format(added, genre))
+  except Exception as e:
+    print("Failed to refill puzzle pool '{}'.".format(pf))
+    traceback.print_exception(*sys.exc_info())
+  finally:
+    try:
+      os.remove(lf)
+    except:
+      print("Failed to clean up lock file '{}'.".format(lf))
+    with POOL_LOCK:
+      REFILLING.discard(genre)
+
 #--------------------#
 # Database Functions #
 #--------------------#
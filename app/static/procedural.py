@@ -9,6 +9,9 @@ import re
 import sys
 import traceback
 import json
+import bisect
+import builtins
+import random
 
 # Brython imports
 import browser
@@ -199,52 +202,55 @@ DEFAULT_PUZZLES_URL = "/puzzle"
 # Scaffolding #
 #-------------#
 
-def make_dict(jsobj, memo=None):
+# Javascript function for JSON.parse that turns each value into a Python value
+# as soon as it's parsed: objects become dictionaries, null becomes None, and
+# numbers with fractional parts become floats (Brython keeps its floats as
+# Number objects). Arrays can stay as they are, since Brython lists are
+# Javascript arrays.
+JSON_REVIVER = browser.window.eval("""(function (key, value) {
+  var $B = __BRYTHON__
+  if (value === null) {
+    return $B.builtins.None
+  } else if (typeof value == "number") {
+    return value % 1 === 0 ? value : $B.$FloatClass(value)
+  } else if (typeof value != "object" || Array.isArray(value)) {
+    return value
+  }
+  var result = $B.builtins.dict.$factory()
+  for (var name in value) {
+    result.$string_dict[name] = value[name]
+  }
+  return result
+})""")
+
+def parse_json(text):
   """
-  Converts a JSObject to a dictionary, and also converts any values
-  recursively.
+  Parses a JSON string into Python dictionaries, lists, strings, numbers,
+  booleans, and None. Parsing and conversion happen together in a single pass
+  in Javascript (see JSON_REVIVER), which is much faster than Python's json
+  module.
   """
-  if memo == None:
-    memo = {}
-  # This is potentially needed to deal with recursive objects:
-  if id(jsobj) in memo:
-    # TODO: Hash collisions?!?
-    return memo[id(jsobj)]
-  if isinstance(jsobj, javascript.JSObject):
-    d1 = jsobj.to_dict()
-    memo[id(jsobj)] = d1
-    for k in d1:
-      d1[k] = make_dict(d1[k], memo)
-    return d1
-  elif (
-    isinstance(jsobj, str)
- or isinstance(jsobj, int)
- or isinstance(jsobj, float)
- or isinstance(jsobj, bool)
- or (hasattr(jsobj, "__eq__") and None == jsobj)
-  ): # already converted?
-    return jsobj
-  elif browser.window.Array.isArray(jsobj) or isinstance(jsobj, list):
-    l1 = []
-    memo[id(jsobj)] = l1
-    for item in jsobj:
-      l1.append(make_dict(item, memo))
-    return l1
-  elif isinstance(jsobj, dict):
-    d1 = {}
-    memo[id(jsobj)] = d1
-    for k in jsobj:
-      d1[k] = make_dict(jsobj[k], memo)
-    return d1
-  else:
-    d1 = {}
-    memo[id(jsobj)] = d1
-    for key in browser.window.Object.keys(jsobj):
-      prd = browser.window.Object.getOwnPropertyDescriptor(jsobj, key)
-      if prd != None:
-        val = prd.value
-        d1[key] = make_dict(val, memo)
-    return d1
+  return browser.window.JSON.parse(text, JSON_REVIVER)
+
+def make_dict(obj):
+  """
+  Converts a Javascript object (or a Python list or dictionary that contains
+  Javascript objects) into Python values, by way of a JSON round trip (see
+  parse_json). Only works for JSON-compatible objects (in particular, there
+  can't be any reference loops).
+  """
+  return parse_json(browser.window.JSON.stringify(obj))
+
+def current_username():
+  """
+  Returns the username of the logged-in user, from the data-username
+  attribute that the page template puts on the user info element, or an empty
+  string if nobody is logged in (or the page doesn't say).
+  """
+  node = browser.document.querySelector("[data-username]")
+  if node == None:
+    return ""
+  return node.getAttribute("data-username") or ""
 
 def error(*messages):
   """
@@ -262,6 +268,21 @@ def log(*messages):
   """
   browser.console.log(*messages)
 
+# Whether to log details that are expensive to format (e.g., the values of
+# passing tests). Use procedural_set_debug(true) in the browser console to
+# turn this on.
+DEBUG = False
+
+def set_debug(on=True):
+  """
+  Turns debugging output on or off (see DEBUG).
+  """
+  global DEBUG
+  DEBUG = bool(on)
+
+# Attach it to the window so it's available in JavaScript
+browser.window.procedural_set_debug = set_debug
+
 def has_class(elt, *classes):
   """
   Returns True if the given DOM element has (any of) the given class(es).
@@ -331,8 +352,100 @@ def line_of(tb):
 
 # TODO: keyboard options!
 
-# global reference to DOM element being dragged
-DRAGGED = None
+# Shared state for drag & drop. There's only ever one drag in progress, so all
+# widgets on the page share this.
+DRAG = {
+  "dragged": None, # the code block DOM element being dragged
+  "hovered": None, # the drop target currently marked as hovered
+  "hover_target": None, # the drop target that should be marked as hovered
+  "frame": None, # ID of the pending animation frame request, if any
+}
+
+# CSS selector for elements that something can be dropped onto
+DROP_TARGET_SELECTOR = ".code_block, .code_slot, .code_bucket"
+
+def drop_target_for(node):
+  """
+  Returns the nearest code block, code slot, or code bucket that contains the
+  given DOM node (possibly the node itself), or None if there isn't one. Each
+  of these elements has a __widget__ property (see setup_base_puzzle), so the
+  widget that the result belongs to can be found directly.
+  """
+  if node == None:
+    return None
+  if not hasattr(node, "closest"): # e.g., a text node
+    node = node.parentNode
+    if node == None or not hasattr(node, "closest"):
+      return None
+  return node.closest(DROP_TARGET_SELECTOR)
+
+def set_drag_state(widget, active):
+  """
+  Marks the given widget as having a drag in progress or not. While a drag is
+  active, the widget node has the 'drag_active' class and its buckets (which
+  contain all valid drop targets) have aria-dropeffect set.
+  """
+  if active:
+    add_class(widget["node"], "drag_active")
+    for bucket in widget["buckets"]:
+      bucket.setAttribute("aria-dropeffect", "move")
+  else:
+    remove_class(widget["node"], "drag_active")
+    for bucket in widget["buckets"]:
+      bucket.removeAttribute("aria-dropeffect")
+
+def request_hover(target):
+  """
+  Requests that the given drop target (or nothing, if target is None) be
+  marked as hovered. The change is applied in the next animation frame (see
+  update_hover), so that however many drag enter/leave events fire, classes
+  only change once per frame.
+  """
+  DRAG["hover_target"] = target
+  if DRAG["frame"] == None:
+    DRAG["frame"] = browser.window.requestAnimationFrame(update_hover)
+
+def update_hover(timestamp=None):
+  """
+  Animation frame callback that moves the 'hovered' class to the most
+  recently requested hover target (see request_hover).
+  """
+  DRAG["frame"] = None
+  old = DRAG["hovered"]
+  new = DRAG["hover_target"]
+  if old != None and (new == None or not old.isSameNode(new)):
+    remove_class(old, "hovered")
+  if new != None:
+    add_class(new, "hovered")
+  DRAG["hovered"] = new
+
+def clear_hover():
+  """
+  Immediately removes the 'hovered' class, cancelling any pending update.
+  """
+  if DRAG["frame"] != None:
+    browser.window.cancelAnimationFrame(DRAG["frame"])
+  DRAG["hover_target"] = None
+  update_hover()
+
+def is_hover_target(target):
+  """
+  Returns True if the given drop target is the currently requested hover
+  target.
+  """
+  current = DRAG["hover_target"]
+  return current != None and current.isSameNode(target)
+
+def valid_drop_target(target):
+  """
+  Returns True if a drag is in progress and the given drop target (see
+  drop_target_for) belongs to the same widget as the dragged block.
+  """
+  return (
+    DRAG["dragged"] != None
+and target != None
+and target.__widget__ is DRAG["dragged"].__widget__
+  )
 
 # Collection of event handlers for dragging & dropping code blocks
 def drag_start(ev):
@@ -340,31 +453,22 @@ def drag_start(ev):
   Handles the drag start event, which happens when the mouse is moved with the
   button held down. The element under the cursor becomes the event's target.
   """
-  global DRAGGED
   # okay to use this here because things inside aren't draggable, so event will
   # bubble to the code_block div, which is.
   if not has_class(ev.target, "code_block"):
     ev.preventDefault()
     return False
 
-  DRAGGED = ev.target
-  add_class(DRAGGED, "dragging")
-  DRAGGED.setAttribute("aria-dragged", "true")
-  ev.dataTransfer.setData('application/x-moz-node', ev.target)
-  ev.dataTransfer.setData('text/html', ev.target.innerHTML)
-  ev.dataTransfer.setData('text/plain', get_code_block_code(ev.target))
-  # Set aria-dropeffect on all valid targets:
-  widget = my_widget(DRAGGED)
-  wnode = widget["node"]
-  buckets = wnode.querySelectorAll(".code_bucket")
-  slots = wnode.querySelectorAll(".code_slot")
-  blocks = wnode.querySelectorAll(".code_block")
-  for item in buckets:
-    item.setAttribute("aria-dropeffect", "move")
-  for item in slots:
-    item.setAttribute("aria-dropeffect", "move")
-  for item in blocks:
-    item.setAttribute("aria-dropeffect", "move")
+  dragged = ev.target
+  DRAG["dragged"] = dragged
+  add_class(dragged, "dragging")
+  dragged.setAttribute("aria-dragged", "true")
+  ev.dataTransfer.setData('application/x-moz-node', dragged)
+  render_code_block(dragged)
+  ev.dataTransfer.setData('text/html', dragged.innerHTML)
+  ev.dataTransfer.setData('text/plain', get_code_block_code(dragged))
+  # Indicate valid drop targets:
+  set_drag_state(dragged.__widget__, True)
   # TODO Why don't the other drag events fire?!?
   #return False
 
@@ -372,25 +476,14 @@ def drag_end(ev):
   """
   Handles the drag end event, which happens when the drag ends without a drop.
   """
-  global DRAGGED
-  # Remove aria-dropeffect from all targets:
-  widget = my_widget(DRAGGED)
-  if widget != None:
-    wnode = widget["node"]
-    buckets = wnode.querySelectorAll(".code_bucket")
-    slots = wnode.querySelectorAll(".code_slot")
-    blocks = wnode.querySelectorAll(".code_block")
-    for item in buckets:
-      item.removeAttribute("aria-dropeffect")
-    for item in slots:
-      item.removeAttribute("aria-dropeffect")
-    for item in blocks:
-      item.removeAttribute("aria-dropeffect")
-
-  # Reset DRAGGED
-  if DRAGGED != None:
-    remove_class(DRAGGED, "dragging")
-    DRAGGED = None
+  dragged = DRAG["dragged"]
+  clear_hover()
+  # Reset the dragged element
+  if dragged != None:
+    set_drag_state(dragged.__widget__, False)
+    remove_class(dragged, "dragging")
+    dragged.setAttribute("aria-dragged", "false")
+    DRAG["dragged"] = None
 
   ev.preventDefault()
   return False
@@ -400,42 +493,33 @@ def drag_enter(ev):
   Handles the drag enter event, when during a drag the mouse is moved over a
   new element (the target).
   """
-  global DRAGGED
-
-  if not same_widget(ev.target, DRAGGED):
+  target = drop_target_for(ev.target)
+  if not valid_drop_target(target):
     return False
 
-  if has_class(ev.target, "code_slot"):
-    block = ev.target
-  else:
-    block = my_code_block(ev.target)
-
-  if block != None and not block.isSameNode(DRAGGED):
+  if (
+    has_class(target, "code_slot", "code_block")
+and not target.isSameNode(DRAG["dragged"])
+  ):
     ev.dataTransfer.dropEffect = "move"
-    add_class(block, "hovered")
+    request_hover(target)
 
 def drag_leave(ev):
   """
   Handles the drag leave event, when during a drag the mouse is moved off of an
-  element (the target) that it was previously over.
+  element (the target) that it was previously over. Note that the drag enter
+  event for the element being moved onto fires first.
   """
-  global DRAGGED
-
-  if not same_widget(ev.target, DRAGGED):
+  target = drop_target_for(ev.target)
+  if not valid_drop_target(target) or not is_hover_target(target):
     return False
 
-  if has_class(ev.target, "code_slot"):
-    block = ev.target
-  else:
-    block = my_code_block(ev.target)
-
-  if block != None:
-    # Block that we're leaving to:
-    to_block = my_code_block(ev.relatedTarget)
+  # Element that we're leaving to:
+  to_target = drop_target_for(ev.relatedTarget)
 
-    if not block.isSameNode(to_block):
-      ev.dataTransfer.dropEffect = "none"
-      remove_class(block, "hovered")
+  if to_target == None or not target.isSameNode(to_target):
+    ev.dataTransfer.dropEffect = "none"
+    request_hover(None)
 
 def drag_over(ev):
   """
@@ -451,77 +535,80 @@ def drag_drop(ev):
   Handles the drag drop event, when during a drag the mouse is released over an
   element (the target).
   """
-  global DRAGGED
   ev.preventDefault()
 
-  # Remove aria-dropeffect from all targets:
-  widget = my_widget(DRAGGED)
-  wnode = widget["node"]
-  buckets = wnode.querySelectorAll(".code_bucket")
-  slots = wnode.querySelectorAll(".code_slot")
-  blocks = wnode.querySelectorAll(".code_block")
-  for item in buckets:
-    item.removeAttribute("aria-dropeffect")
-  for item in slots:
-    item.removeAttribute("aria-dropeffect")
-  for item in blocks:
-    item.removeAttribute("aria-dropeffect")
-
-  if not same_widget(ev.target, DRAGGED):
+  dragged = DRAG["dragged"]
+  if dragged == None:
+    return False
+
+  widget = dragged.__widget__
+  set_drag_state(widget, False)
+  clear_hover()
+
+  target = drop_target_for(ev.target)
+  if not valid_drop_target(target):
     return False
-  my_block = my_code_block(ev.target)
-  if has_class(ev.target, "code_slot") or my_block != None:
+
+  if has_class(target, "code_slot", "code_block"):
     # drop on a slot or code block: insert ourselves after the slot
-    slot = my_block or ev.target
-    if slot.isSameNode(DRAGGED): # drop on ourselves: do nothing
-      ev.preventDefault()
-      remove_class(slot, "hovered")
+    slot = target
+    if slot.isSameNode(dragged): # drop on ourselves: do nothing
       return
-    if my_block != None:
-      before = DRAGGED.previousSibling
-    DRAGGED.parentNode.removeChild(DRAGGED)
-    if my_block != None and slot.isSameNode(before):
+    before = dragged.previousSibling
+    dragged.parentNode.removeChild(dragged)
+    if has_class(slot, "code_block") and slot.isSameNode(before):
       # if we're dropping on a block and it's the block above us, we should
       # swap places instead of going nowhere:
-      slot.parentNode.insertBefore(DRAGGED, slot)
+      slot.parentNode.insertBefore(dragged, slot)
     else:
       # otherwise just add ourselves after the target:
-      slot.parentNode.insertBefore(DRAGGED, slot.nextSibling)
-    # now clean up classes:
-    remove_class(slot, "hovered")
+      slot.parentNode.insertBefore(dragged, slot.nextSibling)
 
-    # Mark errors and tests on this widget as stale:
-    w = my_widget(ev.target)
-    mark_errors_as_stale(w)
-    mark_tests_as_stale(w)
-
-  elif has_class(ev.target, "code_bucket"):
-    # drop on a bucket: add ourselves after the last code block in that bucket:
+  else: # drop on a bucket
+    # add ourselves after the last code block in that bucket:
     last = None
-    for child in ev.target.children:
+    for child in target.children:
       if has_class(child, "code_slot", "code_block"):
         last = child
+    dragged.parentNode.removeChild(dragged)
     if last == None:
-      DRAGGED.parentNode.removeChild(DRAGGED)
-      ev.target.insertBefore(DRAGGED, ev.target.firstChild)
+      target.insertBefore(dragged, target.firstChild)
     else:
-      DRAGGED.parentNode.removeChild(DRAGGED)
-      ev.target.insertBefore(DRAGGED, last.nextSibling)
+      target.insertBefore(dragged, last.nextSibling)
 
-    # Mark errors on this widget as stale:
-    w = my_widget(ev.target)
-    mark_errors_as_stale(w)
-    mark_tests_as_stale(w)
-
-  else:
-    ev.preventDefault()
+  # Mark errors and tests on this widget as stale:
+  mark_errors_as_stale(widget)
+  mark_tests_as_stale(widget)
 
   # reset dragged element's style and then get rid of it:
-  remove_class(DRAGGED, "dragging")
-  DRAGGED = None
+  remove_class(dragged, "dragging")
+  dragged.setAttribute("aria-dragged", "false")
+  DRAG["dragged"] = None
+
+  save_widget_state(widget)
 
   return False
 
+# Handler for each type of drag event (see handle_drag_event)
+DRAG_HANDLERS = {
+  "dragstart": drag_start,
+  "dragend": drag_end,
+  "dragover": drag_over,
+  "dragenter": drag_enter,
+  "dragleave": drag_leave,
+  "drop": drag_drop,
+}
+
+def handle_drag_event(ev):
+  """
+  The single event listener attached to each widget for all drag & drop
+  events (which bubble up from the blocks, slots, and buckets inside it).
+  Dispatches to the appropriate handler in DRAG_HANDLERS.
+  """
+  handler = DRAG_HANDLERS.get(ev.type)
+  if handler != None:
+    return handler(ev)
+
 #--------------------------#
 # DOM Management Functions #
 #--------------------------#
@@ -578,10 +665,13 @@ def handle_linked_option_select(selector):
   selected_value = selector.value
   key = selector.getAttribute("data-options-key")
 
+  # Remember the value (get_code_block_code and blocks that haven't been
+  # rendered yet use this):
+  widget = my_widget(selector)
+  widget["option_values"][key] = selected_value
+
   # Safely update our other option selects without re-triggering this handler:
-  all_selectors = my_widget(selector)["node"].querySelectorAll(
-    ".option_selector"
-  )
+  all_selectors = widget["node"].querySelectorAll(".option_selector")
   matching_selectors = [
     sel for sel in all_selectors if sel.getAttribute("data-options-key") == key
   ]
@@ -590,59 +680,125 @@ def handle_linked_option_select(selector):
     sel.value = selected_value
   DONT_ECHO = False
 
+  save_widget_state(widget)
+
 # Attach it to the window so it's available in JavaScript
 browser.window.handle_linked_option_select = handle_linked_option_select
 
+# Compiled placeholder patterns keyed by tuple of option keys (see
+# option_pattern)
+OPTION_PATTERNS = {}
+
+def option_pattern(keys):
+  """
+  Returns a compiled regular expression that matches the _sel_<key>_
+  placeholder for any of the given option keys, with the key as its only
+  group. Patterns are cached, since every block in a puzzle shares the same
+  keys.
+  """
+  keys = tuple(sorted(keys, key=lambda k: (-len(k), k))) # longest first
+  if keys not in OPTION_PATTERNS:
+    OPTION_PATTERNS[keys] = re.compile(
+      "_sel_({})_".format('|'.join(re.escape(k) for k in keys))
+    )
+  return OPTION_PATTERNS[keys]
+
+def parse_option_template(code, options):
+  """
+  Splits a code string into a template list that alternates between literal
+  code segments (at even indices) and option keys (at odd indices), based on
+  the _sel_<key>_ placeholders for the given options. Returns None if the code
+  doesn't use any of the options.
+  """
+  if len(options) == 0:
+    return None
+  template = option_pattern(options).split(code)
+  if len(template) == 1:
+    return None
+  return template
+
+def fill_option_template(template, values):
+  """
+  Turns a template from parse_option_template back into code, substituting the
+  given value for each option key.
+  """
+  result = template[:]
+  for i in range(1, len(result), 2):
+    result[i] = values[result[i]]
+  return ''.join(result)
+
 def get_code_block_code(block):
   """
   Extracts code from a code block, respecting selected values for any options
-  that might be present.
+  that might be present (as recorded in the widget's option_values).
   """
-  # Grab selectors and figure out their current values:
-  selectors = block.querySelectorAll(".option_selector")
-  values = {}
-  for sel in selectors:
-    values[sel.getAttribute("data-options-key")] = sel.value
+  if not hasattr(block, "__template__") or block.__template__ == None:
+    return block.__code__
 
-  # Substitute option keys in the code with option values:
-  result = block.__code__
-  if not hasattr(block, "__options__"):
-    return result
+  return fill_option_template(
+    block.__template__,
+    block.__widget__["option_values"]
+  )
 
-  for opt in block.__options__:
-    repl = "_sel_{}_".format(opt)
-    while repl in result:
-      index = result.index(repl)
-      if opt not in values:
-        error(
-          (
-            "Option key '{}' not found among selector values for code line:"
-            "\n{}\nValues are:\n{}"
-          ).format(opt, block.__code__, values)
-        )
-        val = ""
-      else:
-        val = values[opt]
-      result = (
-        result[:index]
-      + val
-      + result[index + len(repl):]
-      )
+# Highlighted HTML keyed by code string, shared by all widgets, so that
+# re-loading a puzzle (or showing the same code again) doesn't re-tokenize it.
+HIGHLIGHT_CACHE = {}
+
+# Maximum number of entries in HIGHLIGHT_CACHE (oldest entries are dropped
+# first)
+HIGHLIGHT_CACHE_LIMIT = 2048
+
+# Hit/miss counters for HIGHLIGHT_CACHE
+HIGHLIGHT_CACHE_STATS = { "hits": 0, "misses": 0 }
+
+def highlight_html(code):
+  """
+  Returns HTML for the given Python code string with Prism's syntax
+  highlighting applied, re-using the result from a previous call with the
+  same code if possible. The result is meant to be used as the innerHTML of a
+  code element with the language-python class.
+  """
+  if code in HIGHLIGHT_CACHE:
+    HIGHLIGHT_CACHE_STATS["hits"] += 1
+    return HIGHLIGHT_CACHE[code]
 
+  HIGHLIGHT_CACHE_STATS["misses"] += 1
+  prism = browser.window.Prism
+  result = prism.highlight(code, prism.languages.python, "python")
+  if len(HIGHLIGHT_CACHE) >= HIGHLIGHT_CACHE_LIMIT:
+    # dictionaries are ordered, so this is the oldest entry
+    del HIGHLIGHT_CACHE[next(iter(HIGHLIGHT_CACHE))]
+  HIGHLIGHT_CACHE[code] = result
   return result
 
+def highlight_cache_stats():
+  """
+  Returns a dictionary with the current size of the highlight cache and its
+  hit and miss counts. Available from the browser console as
+  procedural_highlight_cache_stats().
+  """
+  return {
+    "size": len(HIGHLIGHT_CACHE),
+    "hits": HIGHLIGHT_CACHE_STATS["hits"],
+    "misses": HIGHLIGHT_CACHE_STATS["misses"],
+  }
+
+# Attach it to the window so it's available in JavaScript
+browser.window.procedural_highlight_cache_stats = highlight_cache_stats
+
 def add_code_block_to_bucket(bucket, options, code, given=False):
   """
   Adds a block of code to a code block bucket. Creates the requisite DOM
   element and translates from raw code to HTML specifics. Inserts selection
   elements into the code itself if any of the given options keys matches within
   the given code. The given bucket element should be a DOM element with the
-  code_bucket class, and the options should be a dictionary mapping keys to
-  lists of strings (the options for that key). If 'given' is supplied as True,
-  the block of code will be an immovable 'given' code block instead of a
-  moveable active block.
+  code_bucket class (and a __widget__ property), and the options should be a
+  dictionary mapping keys to lists of strings (the options for that key). If
+  'given' is supplied as True, the block of code will be an immovable 'given'
+  code block instead of a moveable active block.
   """
   codeblock = browser.document.createElement("code")
+  codeblock.__widget__ = bucket.__widget__
   add_class(codeblock, "code_block")
   add_class(codeblock, "language-python")
 
@@ -653,37 +809,79 @@ def add_code_block_to_bucket(bucket, options, code, given=False):
     codeblock.setAttribute("aria-dragged", "false")
 
   codeblock.__code__ = code
+  codeblock.__template__ = parse_option_template(code, options)
   codeblock.__options__ = {}
-  for opt in options:
-    if opt in code:
+  if codeblock.__template__ != None:
+    for opt in codeblock.__template__[1::2]:
       codeblock.__options__[opt] = options[opt]
 
-  codeblock.innerHTML = code
-  # Note: this must be innerHTML, not innerText! (otherwise line breaks get
-  # eaten)
-  browser.window.Prism.highlightElement(codeblock)
-
-  inner_html = codeblock.innerHTML
-  for opt in codeblock.__options__:
-    values = codeblock.__options__[opt]
-    repl = "_sel_{}_".format(opt)
-    while repl in inner_html:
-      where = inner_html.index(repl)
-      inner_html = (
-        inner_html[:where]
-      + linked_option_html_for(opt, values)
-      + inner_html[where + len(repl):]
-      )
-  codeblock.innerHTML = inner_html
+  widget = bucket.__widget__
+  observer = widget.get("lazy_observer")
+  if observer == None:
+    render_code_block(codeblock)
+  else:
+    # Just show the raw code for now; render_code_block will be called once
+    # the block scrolls into view.
+    codeblock.__rendered__ = False
+    codeblock.textContent = code
+    observer.observe(codeblock)
 
   bucket.appendChild(codeblock)
 
+def render_code_block(codeblock):
+  """
+  Fills in the contents of a code block created by add_code_block_to_bucket:
+  highlights its code and inserts option selectors (set to the widget's
+  current value for each option key). Does nothing if the block has already
+  been rendered.
+  """
+  if hasattr(codeblock, "__rendered__") and codeblock.__rendered__:
+    return
+  codeblock.__rendered__ = True
+
+  widget = codeblock.__widget__
+  observer = widget.get("lazy_observer")
+  if observer != None:
+    observer.unobserve(codeblock)
+
+  # Option selectors are substituted after the cache lookup, so blocks that
+  # share code also share highlighting no matter which options they have:
+  inner_html = highlight_html(codeblock.__code__)
+  if len(codeblock.__options__) > 0:
+    options = codeblock.__options__
+    inner_html = option_pattern(options).sub(
+      lambda match: linked_option_html_for(
+        match.group(1),
+        options[match.group(1)]
+      ),
+      inner_html
+    )
+  codeblock.innerHTML = inner_html
+
+  # Match options that were changed in other blocks before this one was
+  # rendered:
+  if len(codeblock.__options__) > 0:
+    current = widget["option_values"]
+    for sel in codeblock.querySelectorAll(".option_selector"):
+      sel.value = current[sel.getAttribute("data-options-key")]
+
+def lazy_render_callback(entries, observer):
+  """
+  IntersectionObserver callback that renders code blocks as they come close
+  to being visible (see add_code_block_to_bucket).
+  """
+  for entry in entries:
+    if entry.isIntersecting:
+      render_code_block(entry.target)
+
 def add_empty_slot_to_bucket(bucket):
   """
   Adds an empty slot to a code bucket (should be a DOM element with class
-  code_bucket).
+  code_bucket and a __widget__ property).
   """
-  bucket.appendChild(create_slot())
+  slot = create_slot()
+  slot.__widget__ = bucket.__widget__
+  bucket.appendChild(slot)
 
 def my_widget(node):
   """
@@ -710,25 +908,6 @@ def my_selector(node):
     return None
 
 
-def my_code_block(node):
-  """
-  Figure out which code block a DOM node belongs to. Recursively asks parent
-  DOM node until a node with class code_block is found.
-  """
-  if has_class(node, "code_block"):
-    return node
-  elif hasattr(node, "parentNode"):
-    return my_code_block(node.parentNode)
-  else:
-    return None
-
-def same_widget(a, b):
-  """
-  Generic function for asking if two elements belong to the same widget or not.
-  Just uses my_widget on each and compares results.
-  """
-  return my_widget(a) is my_widget(b)
-
 #----------------------#
 # Evaluation Functions #
 #----------------------#
@@ -759,12 +938,37 @@ def get_enclosing_frame():
 
   return target
 
-def mkprint():
+# Default limits on how many print() calls and how many characters of output
+# are recorded during a check (see mkprint)
+OUTPUT_LINE_LIMIT = 10000
+OUTPUT_SIZE_LIMIT = 1000000
+
+# Recorded in place of any output beyond the limits
+TRUNCATED_OUTPUT = "<output truncated: too much was printed>\n"
+
+# Shown by the test indicator when output was truncated during a check (see
+# report_test_results)
+TRUNCATED_MESSAGE = (
+  "Too much output was printed, so your solution could not be fully checked."
+)
+
+def mkprint(env=None, line_limit=None, size_limit=None):
   """
-  Creates print, printed, and reset_output functions for use in testing.
-  The created functions use their own output list.
+  Creates print, printed, printed_by, reset_output, and output_truncated
+  functions for use in testing. The created functions use their own output
+  list, which records at most line_limit print() calls and size_limit
+  characters (OUTPUT_LINE_LIMIT and OUTPUT_SIZE_LIMIT by default). Output
+  beyond that is dropped and TRUNCATED_OUTPUT is recorded once instead. If an
+  environment is given, printed_by runs code in it; otherwise it uses the
+  globals of its caller.
   """
+  if line_limit == None:
+    line_limit = OUTPUT_LINE_LIMIT
+  if size_limit == None:
+    size_limit = OUTPUT_SIZE_LIMIT
   _output = []
+  _size = 0
+  _truncated = False
 
   def print(*args, **kwargs):
     """
@@ -773,9 +977,11 @@ def mkprint():
     string of output, output is stored as a list of (maybe multiline) strings
     that came from individual calls to print().
     """
-    nonlocal _output
+    nonlocal _output, _size, _truncated
     if 'file' in kwargs:
-      print(*args, **kwargs)
+      builtins.print(*args, **kwargs)
+    elif _truncated:
+      return
     else:
       end = kwargs.get('end')
       if end == None: # allows explicit None
@@ -784,7 +990,12 @@ def mkprint():
       if sep == None: # allows explicit None
         sep = ' '
       output = sep.join(str(x) for x in args) + end
-      _output.append(output)
+      if len(_output) >= line_limit or _size + len(output) > size_limit:
+        _truncated = True
+        _output.append(TRUNCATED_OUTPUT)
+      else:
+        _size += len(output)
+        _output.append(output)
 
   def printed(n):
     """
@@ -826,9 +1037,11 @@ def mkprint():
     """
     nonlocal _output
     olen = len(_output)
-    # TODO: something better than this DISGUSTING HACK?
-    env = get_enclosing_frame().f_globals
-    exec(some_code, env)
+    if env != None:
+      exec(some_code, env)
+    else:
+      # TODO: something better than this DISGUSTING HACK?
+      exec(some_code, get_enclosing_frame().f_globals)
     my_output = _output[olen:] # any new additions
     rlen = len(my_output)
     if n == None:
@@ -849,10 +1062,19 @@ def mkprint():
     """
     Erases output recorded using fake print. Use for testing purposes.
     """
-    nonlocal _output
+    nonlocal _output, _size, _truncated
     _output = []
+    _size = 0
+    _truncated = False
+
+  def output_truncated():
+    """
+    Returns True if output has been dropped because there was too much of it
+    (see mkprint).
+    """
+    return _truncated
 
-  return print, printed, printed_by, reset_output
+  return print, printed, printed_by, reset_output, output_truncated
 
 def mkinput(inputs=None, input_limit=None):
   """
@@ -898,22 +1120,36 @@ def mkinput(inputs=None, input_limit=None):
 
   return (input, reset_input)
 
-def mkenv(inputs=None, input_limit=None):
+def mkenv(inputs=None, input_limit=None, output_limit=None, size_limit=None):
   """
   Creates an execution environment where input() calls will receive the given
-  inputs one by one (inputs must be a list of strings if provided).
+  inputs one by one (inputs must be a list of strings if provided). The output
+  and size limits are passed on to mkprint. Returns the environment along
+  with mkprint's output_truncated function, which is kept out of the
+  environment so that student code can't hide truncation by replacing it.
   """
   result = {}
 
   # Create fake print & input functions:
-  print, printed, printed_by, reset_output = mkprint()
+  print, printed, printed_by, reset_output, output_truncated = mkprint(
+    result,
+    output_limit,
+    size_limit
+  )
   input, reset_input = mkinput(inputs, input_limit)
 
   # Make fake functions available as globals:
-  for f in (print, printed, printed_by, reset_output, input, reset_input):
+  for f in (
+    print,
+    printed,
+    printed_by,
+    reset_output,
+    input,
+    reset_input
+  ):
     result[f.__name__] = f
 
-  return result
+  return result, output_truncated
 
 def exec_code(code, env=None):
   """
@@ -922,23 +1158,50 @@ def exec_code(code, env=None):
   newly-constructed environment if no environment was given).
   """
   if env == None:
-    env = mkenv() # create a new environment
+    env, _ = mkenv() # create a new environment
 
   # module context has same globals & locals
+  # Note: Brython transpiles the code to Javascript on every exec, and the
+  # Javascript it generates refers to namespace IDs made up fresh for each
+  # call, so there's no transpiled form that could be cached and re-used.
   exec(code, env)
 
   return env
 
-def get_code_string(bucket):
+def code_index(bucket):
   """
-  Gets the current code string for a bucket.
+  Assembles the code in a bucket, returning a dictionary with keys:
+
+    code: The full code string.
+    blocks: A list of the code block elements, in order.
+    codes: A list of the code strings of those blocks.
+    offsets: A list where entry i is the number of code lines before block i,
+      with one extra entry at the end holding the total number of lines.
+
+  The offsets are used to map line numbers in the full code back to blocks
+  (see block_and_line_responsible_for).
   """
-  code = ""
+  blocks = []
+  codes = []
+  offsets = [0]
   for child in bucket.children:
     if child.hasOwnProperty("__code__"):
-      code += get_code_block_code(child) + '\n'
-  code = code[:-1] # remove trailing newline
-  return code
+      code = get_code_block_code(child)
+      blocks.append(child)
+      codes.append(code)
+      offsets.append(offsets[-1] + code.count('\n') + 1)
+  return {
+    "code": '\n'.join(codes),
+    "blocks": blocks,
+    "codes": codes,
+    "offsets": offsets,
+  }
+
+def get_code_string(bucket):
+  """
+  Gets the current code string for a bucket.
+  """
+  return code_index(bucket)["code"]
 
 def get_code_list(bucket):
   """
@@ -965,7 +1228,9 @@ def eval_button_handler(ev):
   puzzle = widget["puzzle"]
   remove_errors(widget)
   mark_tests_as_fresh(widget)
-  code = get_code_string(bucket)
+  index = code_index(bucket)
+  widget["code_index"] = index # see mark_errors_as_stale
+  code = index["code"]
   log("Running code:\n---\n{}\n---".format(code))
   exception = None
 
@@ -976,7 +1241,12 @@ def eval_button_handler(ev):
       if isinstance(inputs, str):
         inputs = inputs.split('\n')
 
-    env = mkenv(inputs, puzzle.get("input_limit"))
+    env, output_truncated = mkenv(
+      inputs,
+      puzzle.get("input_limit"),
+      puzzle.get("output_limit"),
+      puzzle.get("output_size_limit")
+    )
 
     if "preexec" in puzzle:
       log("Pre-exec:", puzzle["preexec"]);
@@ -996,7 +1266,7 @@ def eval_button_handler(ev):
       except Exception as e:
         exception = trap_exception(e)
         log("Result was an exception:\n{}".format(format_error(exception)))
-        attach_error_message(bucket, exception)
+        attach_error_message(bucket, exception, index=index)
 
     # Now run the pre-test code
     pte = None
@@ -1012,12 +1282,19 @@ def eval_button_handler(ev):
 
     # Now run tests and report results:
     test_results = run_tests(widget, env)
-    report_test_results(widget, test_results, exception, pte)
+    report_test_results(
+      widget,
+      test_results,
+      exception,
+      pte,
+      output_truncated()
+    )
+    save_widget_state(widget)
 
   except Exception as e:
     pte = trap_exception(e)
     error("Something went horribly wrong during testing:\n" + format_error(pte))
-    attach_error_message(bucket, pte)
+    attach_error_message(bucket, pte, index=index)
 
   finally:
     # Finally re-enable the button
@@ -1081,15 +1358,34 @@ def remove_element_from_page(x):
   browser.document.body.removeChild(x)
 
 
-def attach_error_message(bucket, error_obj, expected=False):
+def attach_error_message(bucket, error_obj, expected=False, index=None):
   """
   Given a code bucket (that was just evaluated) and a TracebackException object
   (which resulted from that evaluation), this method generates an error DOM
   node and attaches it to the relevant code block in the given bucket. If
-  expected is true, the error is marked as an expected error.
-  """
-  block, line = block_and_line_responsible_for(bucket, error_obj)
-  attach_error_message_at_line(block, line, error_obj, expected=expected)
+  expected is true, the error is marked as an expected error. The index
+  should be the code_index of the code that was evaluated (it will be
+  computed if not given).
+  """
+  if index == None:
+    index = code_index(bucket)
+  block, line = block_and_line_responsible_for(bucket, error_obj, index)
+  err = attach_error_message_at_line(block, line, error_obj, expected=expected)
+  # Remember which line of the whole program the error was attached to (see
+  # mark_errors_as_stale), going by its block's offset. Syntax errors depend
+  # on all of the code, and errors with lines outside the code (e.g., from
+  # pre-test code) can't be placed, so those get None.
+  err.__program_line__ = None
+  error_line = error_obj[2]
+  if (
+    not issubclass(error_obj[0], SyntaxError)
+and error_line != None
+and 0 < error_line <= index["offsets"][-1]
+  ):
+    for i, candidate in enumerate(index["blocks"]):
+      if candidate.isSameNode(block):
+        err.__program_line__ = index["offsets"][i] + line
+        break
 
 def attach_error_mesage_to_code(node, error_obj, expected=False):
   """
@@ -1102,9 +1398,13 @@ def attach_error_mesage_to_code(node, error_obj, expected=False):
 def attach_error_message_at_line(code_elem, line, error_obj, expected=False):
   """
   Attaches an error message to the given code element indicating that the given
-  error occurred on the given line (inside the element).
+  error occurred on the given line (inside the element). Returns the new error
+  element.
   """
   error_type, error_msg, error_line, error_offset = error_obj
+  # Rendering a block replaces its contents, so do that first:
+  if hasattr(code_elem, "__rendered__"):
+    render_code_block(code_elem)
   exc_msg = "{}: {}".format(error_type.__name__, error_msg)
   err = browser.document.createElement("details")
   add_class(err, "error")
@@ -1129,12 +1429,12 @@ def attach_error_message_at_line(code_elem, line, error_obj, expected=False):
     add_class(errdesc, "error_description")
     errcode = browser.document.createElement("code")
     add_class(errcode, "language-python")
-    errcode.innerHTML = "<unknown line>"
+    err_line = "<unknown line>"
     if line != None:
       clines = code_string.split('\n')
       if 0 <= line < len(clines):
-        errcode.innerHTML = clines[line]
-    browser.window.Prism.highlightElement(errcode) # highlight just the code
+        err_line = clines[line]
+    errcode.innerHTML = highlight_html(err_line) # highlight just the code
     errdesc.appendChild(errcode)
     # add the caret and message after the code
     caret_text = '<br/>' + ('&nbsp;' * error_offset) + '^'
@@ -1160,8 +1460,7 @@ def attach_error_message_at_line(code_elem, line, error_obj, expected=False):
       add_class(errdesc, "error_description")
       errcode = browser.document.createElement("code")
       add_class(errcode, "language-python")
-      errcode.innerText = err_line
-      browser.window.Prism.highlightElement(errcode) # highlight just the code
+      errcode.innerHTML = highlight_html(err_line) # highlight just the code
       errdesc.appendChild(errcode)
       err.appendChild(errdesc)
     else:
@@ -1172,50 +1471,73 @@ def attach_error_message_at_line(code_elem, line, error_obj, expected=False):
       )
 
   code_elem.appendChild(err)
+  return err
 
-def block_and_line_responsible_for(bucket, error_obj):
+def block_and_line_responsible_for(bucket, error_obj, index=None):
   """
   Figures out which block of code in a bucket was responsible for the given
-  traceback by counting code lines and looking at the traceback's final line
-  number. Also returns the line number within that block, as the second part of
-  a tuple. Logs an error and returns None if the line number is out of range
-  for the code block.
+  traceback by looking up the traceback's final line number in the line
+  offsets of the given code_index (which is computed from the bucket if not
+  given). Also returns the line number within that block, as the second part
+  of a tuple. Logs an error and returns the first block and line 0 if the line
+  number is out of range for the code.
   """
   error_type, error_msg, error_line, error_offset = error_obj
-  sofar = 0
-  first = None
-  last = None
-  lines = None
-  for child in bucket.children:
-    if child.hasOwnProperty("__code__"):
-      if first == None:
-        first = child
-      last = child
-      lines = len(get_code_block_code(child).split('\n'))
-      if sofar + lines >= error_line:
-        return (child, error_line - 1 - sofar)
-      else:
-        sofar += lines
-  if error_line == sofar + 1 and last != None:
+  if index == None:
+    index = code_index(bucket)
+  blocks = index["blocks"]
+  offsets = index["offsets"]
+  if len(blocks) == 0:
+    error("No code blocks to attach error to!")
+    return (None, 0)
+
+  if error_line == None:
+    return (blocks[0], None)
+
+  target = error_line - 1 # line numbers start at 1
+  which = bisect.bisect_right(offsets, target) - 1
+  if 0 <= which < len(blocks):
+    return (blocks[which], target - offsets[which])
+  elif target == offsets[-1]:
     # e.g., an indentation error on final added blank line
-    return (last, lines - 1)
+    return (blocks[-1], offsets[-1] - offsets[-2] - 1)
+
   error("Ran out of code lines trying to find responsible block!")
   error(
-    "children: {}, lines: {}, target: {}".format(
-      len(bucket.children),
-      sofar,
+    "blocks: {}, lines: {}, target: {}".format(
+      len(blocks),
+      offsets[-1],
       error_line
     )
   )
-  return (first, 0)
+  return (blocks[0], 0)
 
 def mark_errors_as_stale(widget):
   """
-  Marks all errors in the given widget as stale (presumably because they're no
-  longer 100% valid as code has been moved around).
-  """
+  Marks errors in the given widget as stale (presumably because they're no
+  longer 100% valid as code has been moved around). Code runs top to bottom,
+  so errors from the solution that were raised before the first line that
+  changed since the code was checked stay fresh (syntax errors and test errors
+  always become stale).
+  """
+  first_change = 0
+  old = widget.get("code_index")
+  if old != None:
+    new = code_index(widget["soln_bucket"])
+    first_change = old["offsets"][-1]
+    for i, block in enumerate(old["blocks"]):
+      if (
+        i >= len(new["blocks"])
+     or not new["blocks"][i].isSameNode(block)
+     or new["codes"][i] != old["codes"][i]
+      ):
+        first_change = old["offsets"][i]
+        break
+
   for node in widget["node"].querySelectorAll(".error"):
-    add_class(node, "stale")
+    line = getattr(node, "__program_line__", None)
+    if line == None or line >= first_change:
+      add_class(node, "stale")
 
 def remove_errors(widget):
   """
@@ -1235,10 +1557,11 @@ def mark_tests_as_stale(widget):
 def mark_tests_as_fresh(widget):
   """
   Removes the 'stale' class from all tests in the widget, along with the
-  'passed' and 'failed' classes.
+  'passed' and 'failed' classes (and any description of a difference).
   """
   for node in widget["node"].querySelectorAll(".test_feedback"):
     remove_class(node, "stale", "passed", "failed")
+    node.querySelector(".test_value").removeAttribute("title")
 
 def run_tests(widget, env):
   """
@@ -1255,6 +1578,8 @@ def run_tests(widget, env):
     "exp_exception": The exception thrown when evaluating the expected value,
       if any. Expected will be None in this case.
     "passed": Whether the test passed (True) or failed (False).
+    "difference" (only for failed value tests): A description of where the
+      result first differs from the expected value (see first_difference).
 
   Returns None if the widget doesn't have any tests. Note that the same
   environment is used for all tests, so earlier tests are allowed to influence
@@ -1268,11 +1593,8 @@ def run_tests(widget, env):
   if "tests" not in widget["puzzle"]: # no tests, so just check for errors...
     return None
 
-  tests = widget["puzzle"]["tests"]
-
   results = []
-  for test in tests:
-    test = full_test(test)
+  for test in widget["tests"]:
     texpr = test["expression"]
     if "expect_error" in test:
       texpect = test["expect_error"]
@@ -1304,20 +1626,24 @@ def run_tests(widget, env):
       tresult["exception"] = trap_exception(e)
 
     # TODO: Try to catch infinite loops here?
-    try:
-      # module context uses same globals & locals
-      tresult["expected"] = eval(texpect, env)
-      if "round" in test:
-        tresult["expected"] = round(tresult["expected"], test["round"])
-      if "expect_error" in test and test["expect_error"] != None:
-        if not isinstance(tresult["expected"], Exception):
-          error(
-            "Expected expression didn't result in an Exception object even "
-          + "though expect_error was not None!"
-          )
-        tresult["expected"] = trap_exception(tresult["expected"])
-    except Exception as e:
-      tresult["exp_exception"] = trap_exception(e)
+    if texpect == None:
+      # expect_error is None, meaning that no error is expected
+      pass
+    else:
+      try:
+        # module context uses same globals & locals
+        tresult["expected"] = eval(texpect, env)
+        if "round" in test:
+          tresult["expected"] = round(tresult["expected"], test["round"])
+        if "expect_error" in test:
+          if not isinstance(tresult["expected"], Exception):
+            error(
+              "Expected expression didn't result in an Exception object even "
+            + "though expect_error was not None!"
+            )
+          tresult["expected"] = trap_exception(tresult["expected"])
+      except Exception as e:
+        tresult["exp_exception"] = trap_exception(e)
 
     # Can't pass the test if we weren't able to evaluate the expression or the
     # expected expression:
@@ -1336,22 +1662,22 @@ def run_tests(widget, env):
       if tresult["exception"] != None:
         tresult["passed"] = False
       else:
-        try:
-          result_repr = my_repr(tresult["result"])
-        except RecursionError:
-          result_repr = "<result cannot be represented>"
-        try:
-          exp_repr = my_repr(tresult["expected"])
-        except RecursionError:
-          exp_repr = "<expected value cannot be represented>"
-        log(
-          "Testing...\n{} == {} ? {}".format(
-            result_repr,
-            exp_repr,
-            tresult["result"] == tresult["expected"]
-          )
-        )
         tresult["passed"] = tresult["result"] == tresult["expected"]
+        # Formatting big values is slow, so only do it when it's useful:
+        if DEBUG or not tresult["passed"]:
+          log(
+            "Testing...\n{} == {} ? {}".format(
+              short_repr(tresult["result"]),
+              short_repr(tresult["expected"]),
+              tresult["passed"]
+            )
+          )
+        if not tresult["passed"]:
+          tresult["difference"] = first_difference(
+            tresult["result"],
+            tresult["expected"]
+          )
+          log("Difference: {}".format(tresult["difference"]))
 
     # Record the result for this test and continue to the next
     results.append(tresult)
@@ -1399,14 +1725,174 @@ def my_repr(thing, memo=None):
       result = '***'
     return result
 
-def report_test_results(widget, results, error_obj=None, pretest_error=None):
+# Maximum length of strings produced by short_repr
+SHORT_REPR_LIMIT = 200
+
+def short_repr(thing, limit=None):
+  """
+  Works like my_repr, but stops building the string once it gets longer than
+  the limit (SHORT_REPR_LIMIT by default) and ends it with '...' instead, so
+  that huge values can be logged cheaply. Uses an explicit stack instead of
+  recursion, so deeply nested values don't cause a RecursionError. Only a
+  list, tuple, or dictionary that contains itself is shown as '...'; values
+  that just appear more than once are shown each time.
+  """
+  if limit == None:
+    limit = SHORT_REPR_LIMIT
+  parts = []
+  size = 0
+  # IDs of the containers whose contents are currently being written:
+  active = set()
+  # Entries are ("text", text) for literal text, ("value", value) for values,
+  # ("items", [iterator, is_dict, first]) for the rest of a container's
+  # contents (taken one item at a time, so huge containers aren't copied), or
+  # ("leave", id) to mark the end of a container's contents
+  stack = [("value", thing)]
+  while stack and size <= limit:
+    kind, here = stack.pop()
+    if kind == "leave":
+      active.discard(here)
+      continue
+    elif kind == "items":
+      iterator, is_dict, first = here
+      try:
+        item = next(iterator)
+      except StopIteration:
+        continue
+      here[2] = False
+      # Push in reverse order, so that things come off the stack in order:
+      stack.append(("items", here))
+      if is_dict:
+        stack.append(("value", item[1]))
+        stack.append(("text", ':'))
+        stack.append(("value", item[0]))
+      else:
+        stack.append(("value", item))
+      if not first:
+        stack.append(("text", ', '))
+      continue
+    elif kind == "text":
+      text = here
+    elif isinstance(here, (list, tuple, dict)):
+      if id(here) in active:
+        text = '...'
+      else:
+        active.add(id(here))
+        if isinstance(here, dict):
+          brackets = '{}'
+          iterator = iter(here.items())
+        else:
+          brackets = '[]' if isinstance(here, list) else '()'
+          iterator = iter(here)
+        closing = brackets[1]
+        if isinstance(here, tuple) and len(here) == 1:
+          closing = ',)'
+        stack.append(("leave", id(here)))
+        stack.append(("text", closing))
+        stack.append(("items", [iterator, isinstance(here, dict), True]))
+        text = brackets[0]
+    else:
+      try:
+        text = repr(here)
+      except RecursionError:
+        text = '***'
+    parts.append(text)
+    size += len(text)
+
+  # The loop only stops early once the result is over the limit:
+  result = ''.join(parts)
+  if len(result) > limit:
+    result = result[:limit] + '...'
+  return result
+
+# Maximum number of pairs of items that first_difference will compare
+DIFF_STEP_LIMIT = 100000
+
+# Marks a length check in first_difference's stack
+LENGTH_MISMATCH = object()
+
+def first_difference(actual, expected):
+  """
+  Returns a string describing the first place (in order) where the actual
+  value differs from the expected value, looking inside lists, tuples, and
+  dictionaries (other values are compared with ==). Returns None if no
+  difference is found. Gives up after DIFF_STEP_LIMIT comparisons. Works
+  iteratively, so deeply nested values are fine.
+  """
+  steps = 0
+  seen = set()
+  # Entries are (path, actual, expected), where path is a string like [3]['a']
+  stack = [("", actual, expected)]
+  while stack:
+    steps += 1
+    if steps > DIFF_STEP_LIMIT:
+      return "no difference in the first {} items compared".format(
+        DIFF_STEP_LIMIT
+      )
+    path, a, b = stack.pop()
+    where = "at {}".format(path) if path else "at top level"
+
+    if a is LENGTH_MISMATCH:
+      return "{}: got {} items but expected {}".format(where, b[0], b[1])
+
+    if (id(a), id(b)) in seen:
+      continue
+
+    if type(a) != type(b) and not (
+      isinstance(a, (int, float)) and isinstance(b, (int, float))
+    ):
+      return "{}: got {} {} but expected {} {}".format(
+        where,
+        type(a).__name__,
+        short_repr(a),
+        type(b).__name__,
+        short_repr(b)
+      )
+
+    if isinstance(a, (list, tuple)):
+      seen.add((id(a), id(b)))
+      if len(a) != len(b):
+        # checked after the shared items, since those come first
+        stack.append((path, LENGTH_MISMATCH, (len(a), len(b))))
+      for i in range(min(len(a), len(b)) - 1, -1, -1):
+        stack.append(("{}[{}]".format(path, i), a[i], b[i]))
+
+    elif isinstance(a, dict):
+      seen.add((id(a), id(b)))
+      missing = [key for key in b if key not in a]
+      if missing:
+        return "{}: missing key {}".format(where, short_repr(missing[0]))
+      extra = [key for key in a if key not in b]
+      if extra:
+        return "{}: unexpected key {}".format(where, short_repr(extra[0]))
+      for key in reversed(list(b)):
+        stack.append(("{}[{}]".format(path, short_repr(key)), a[key], b[key]))
+
+    elif a != b:
+      return "{}: got {} but expected {}".format(
+        where,
+        short_repr(a),
+        short_repr(b)
+      )
+
+  return None
+
+def report_test_results(
+  widget,
+  results,
+  error_obj=None,
+  pretest_error=None,
+  output_truncated=False
+):
   """
   Reports test results by updating the status of individual test blocks and/or
   attaching errors to them. If there was an error before testing could be
   initiated (either an error value from execing the code or a pretest_error
   value from attempting the pretest code) tests won't be updated and an error
   indicator will be shown (attaching those errors to the DOM is not handled
-  here).
+  here). If output_truncated is True (too much was printed; see mkprint), the
+  puzzle isn't solved, and the indicator says why, but individual test results
+  are still shown.
   """
   ind = widget["test_indicator"]
   soln_blocks = list(widget["soln_bucket"].querySelectorAll(".code_block"))
@@ -1429,6 +1915,9 @@ def report_test_results(widget, results, error_obj=None, pretest_error=None):
       + "probably not correct."
       )
       mark_unsolved(widget)
+    elif output_truncated:
+      ind.innerText = TRUNCATED_MESSAGE
+      mark_unsolved(widget)
     else: # No errors: puzzle solved (or empty)
       src_blocks = list(
         widget["source_bucket"].querySelectorAll(".code_block")
@@ -1465,7 +1954,11 @@ def report_test_results(widget, results, error_obj=None, pretest_error=None):
       mark_unsolved(widget)
     else:
       ind.innerText = "{} / {} tests passed".format(len(passed), len(results))
-      if len(passed) == len(results):
+      if output_truncated:
+        # printed() can't be trusted, so the puzzle can't count as solved
+        ind.innerText += " ({})".format(TRUNCATED_MESSAGE)
+        mark_unsolved(widget)
+      elif len(passed) == len(results):
         mark_solved(widget, solution)
         ind.innerText += " (puzzle solved!)"
       else:
@@ -1475,12 +1968,13 @@ def report_test_results(widget, results, error_obj=None, pretest_error=None):
         # report pass/fail for individual tests
         for i, r in enumerate(results):
           tnode = widget["test_elements"][i]
-          test = full_test(widget["puzzle"]["tests"][i])
+          test = widget["tests"][i]
           tval = tnode.querySelector(".test_value")
           texp = tnode.querySelector(".test_expected")
 
           # Mark as passed/failed
-          log("Test #{}: {}".format(i, r))
+          if DEBUG:
+            log("Test #{}: {}".format(i, r))
           if r["passed"]:
             add_class(tnode, "passed")
           else:
@@ -1567,6 +2061,9 @@ def report_test_results(widget, results, error_obj=None, pretest_error=None):
                   tval.innerText = my_repr(r["result"])
                 except RecursionError:
                   tval.innerText = "<result cannot be represented>"
+                if r.get("difference") != None:
+                  # shows where the values diverge on hover
+                  tval.title = "Difference " + r["difference"]
 
             if r["exp_exception"] != None:
               texp.innerText = "<error trying to figure out expected value>"
@@ -1591,11 +2088,6 @@ def mark_solved(widget, solution):
   # If the widget has a solution URL, report the solution
   if widget["submit_url"]:
     status_div = widget["submission_status"]
-    if has_class(status_div, "active"):
-      # there's already a submission in flight...
-      log(
-        "Warning: solution re-submitted while prior submission was in flight."
-      )
     remove_class(status_div, "succeeded", "failed")
     add_class(status_div, "active")
     status_div.innerHTML = (
@@ -1606,14 +2098,7 @@ def mark_solved(widget, solution):
     #sol_json = json.dumps(solution)
     puzzle_json = browser.window.JSON.stringify(widget["puzzle"])
     sol_json = browser.window.JSON.stringify(solution)
-    handler = feedback_handler(widget)
-    browser.ajax.post(
-      widget["submit_url"],
-      data={'puzzle': puzzle_json, 'solution': sol_json},
-      oncomplete=handler,
-      timeout=25,
-      ontimeout=handler
-    )
+    enqueue_submission(widget, puzzle_json, sol_json)
 
 def mark_unsolved(widget):
   """
@@ -1651,57 +2136,653 @@ def reason_for(status):
   else:
     return "unknown ({})".format(status)
 
-def feedback_handler(widget):
+#------------------#
+# Submission Queue #
+#------------------#
+
+# Solutions waiting to be uploaded, keyed by submission ID (see
+# submission_id). Each entry is a dictionary with keys:
+#
+#   id: The submission ID.
+#   url: The URL to post it to.
+#   batch: Whether that URL accepts batches of solutions (see
+#     route_solved_batch in the server) or just one at a time.
+#   puzzle, solution: JSON strings for the puzzle and solution.
+#   user: The username of the student who found the solution ('' if they
+#     weren't logged in).
+#
+# Entries are also kept in IndexedDB (when available) until they've been
+# uploaded, so that solutions found while offline get delivered later, even
+# if the page is closed in the meantime. Entries left over from earlier visits
+# are only uploaded for the user who found them, so that on a shared machine
+# one student's solutions never get credited to the next student who logs in.
+SUBMISSIONS = {}
+
+# Widgets to update with the status of each submission, by submission ID
+SUBMISSION_WIDGETS = {}
+
+# IDs of submissions uploaded since the page was loaded (re-submitting the same
+# solution to the same puzzle doesn't upload it again)
+SUBMITTED = set()
+
+# Submission queue state
+SUBMISSION_QUEUE = {
+  "db": None, # the IndexedDB database, once it's open
+  "in_flight": False, # whether an upload request is pending
+  "failures": 0, # number of consecutive failed upload attempts
+  "timer": None, # setTimeout ID for the next upload attempt
+  "paused": False, # whether uploads wait for the user to log in
+}
+
+SUBMISSION_DB_NAME = "procedural_submissions"
+SUBMISSION_STORE = "queue"
+
+# Maximum number of solutions to upload in one request
+SUBMISSION_BATCH_SIZE = 20
+
+# Retry delays double after each failure, from the base up to the maximum (in
+# milliseconds), and are then randomized (see retry_delay)
+SUBMISSION_RETRY_BASE = 2000
+SUBMISSION_RETRY_MAX = 5 * 60 * 1000
+
+# Upload request timeout (in seconds)
+SUBMISSION_TIMEOUT = 25
+
+def solution_hash(text):
   """
-  Creates a feedback handler for solution submissions by the given widget.
+  Returns a short hash string for the given text (32-bit FNV-1a), which is
+  stable across page loads, unlike hash().
   """
+  result = 0x811c9dc5
+  for char in text:
+    result = ((result ^ ord(char)) * 0x01000193) & 0xffffffff
+  return "{:08x}".format(result)
 
-  def handle_solution_feedback(req):
+def submission_id(puzzle, sol_json):
+  """
+  Returns the submission ID for the given solution (a JSON string) to the
+  given puzzle. Identical solutions to the same puzzle get the same ID.
+  """
+  return "{}:{}".format(
+    puzzle.get("id", "__unknown__"),
+    solution_hash(sol_json)
+  )
+
+def retry_delay(failures):
+  """
+  Returns how long to wait (in milliseconds) before the next upload attempt
+  after the given number of consecutive failures. The delay grows
+  exponentially, and is randomized so that lots of students who lost their
+  connection at the same time don't all retry at once.
+  """
+  delay = min(
+    SUBMISSION_RETRY_MAX,
+    SUBMISSION_RETRY_BASE * 2 ** min(failures - 1, 20)
+  )
+  return int(random.uniform(delay / 2, delay))
+
+def enqueue_submission(widget, puzzle_json, sol_json):
+  """
+  Adds a solution found by the given widget to the submission queue, and
+  tries to upload it right away. The widget's submission status div is
+  updated as the upload succeeds or fails.
+  """
+  sub_id = submission_id(widget["puzzle"], sol_json)
+  if sub_id in SUBMITTED:
+    notify_submission_widget(
+      widget,
+      "succeeded",
+      "Solution uploaded successfully."
+    )
+    return
+
+  if widget["submit_batch_url"]:
+    url = widget["submit_batch_url"]
+    batch = True
+  else:
+    url = widget["submit_url"]
+    batch = False
+
+  entry = {
+    "id": sub_id,
+    "url": url,
+    "batch": batch,
+    "puzzle": puzzle_json,
+    "solution": sol_json,
+    "user": current_username(),
+  }
+  if sub_id not in SUBMISSIONS:
+    SUBMISSIONS[sub_id] = entry
+    store_submission(entry)
+
+  widgets = SUBMISSION_WIDGETS.setdefault(sub_id, [])
+  if not any(other is widget for other in widgets):
+    widgets.append(widget)
+
+  SUBMISSION_QUEUE["failures"] = 0 # a new solution deserves a prompt try
+  SUBMISSION_QUEUE["paused"] = False # they may have logged in since
+  schedule_submission_flush(0)
+
+def notify_submission_widget(widget, status, message):
+  """
+  Updates the submission status div of the given widget. The status should
+  be 'active', 'succeeded', or 'failed'.
+  """
+  status_div = widget["submission_status"]
+  remove_class(status_div, "active", "succeeded", "failed")
+  add_class(status_div, status)
+  status_div.innerHTML = message
+
+def notify_submission(sub_id, status, message):
+  """
+  Updates the submission status of each widget waiting on the given
+  submission (see notify_submission_widget).
+  """
+  for widget in SUBMISSION_WIDGETS.get(sub_id, []):
+    notify_submission_widget(widget, status, message)
+
+def schedule_submission_flush(delay):
+  """
+  Arranges for flush_submissions to be called after the given delay (in
+  milliseconds), replacing any previously scheduled call.
+  """
+  if SUBMISSION_QUEUE["timer"] != None:
+    browser.window.clearTimeout(SUBMISSION_QUEUE["timer"])
+  SUBMISSION_QUEUE["timer"] = browser.window.setTimeout(
+    flush_submissions,
+    delay
+  )
+
+def flush_submissions():
+  """
+  Uploads the next batch of queued solutions (or the next solution, for
+  widgets without a batch URL), unless an upload is already in flight or the
+  browser is offline (an 'online' event will call this again). Does nothing
+  while the queue is paused because the user isn't logged in; a new
+  submission (see enqueue_submission) or logging in (which reloads the page)
+  resumes it.
+  """
+  SUBMISSION_QUEUE["timer"] = None
+  if (
+    SUBMISSION_QUEUE["in_flight"]
+ or SUBMISSION_QUEUE["paused"]
+ or len(SUBMISSIONS) == 0
+  ):
+    return
+  if not browser.window.navigator.onLine:
+    return
+
+  first = next(iter(SUBMISSIONS.values()))
+  if first["batch"]:
+    batch = [
+      entry
+      for entry in SUBMISSIONS.values()
+      if entry["batch"] and entry["url"] == first["url"]
+    ][:SUBMISSION_BATCH_SIZE]
+    data = {
+      "submissions": json.dumps([
+        {
+          "id": entry["id"],
+          "puzzle": entry["puzzle"],
+          "solution": entry["solution"],
+        }
+        for entry in batch
+      ])
+    }
+  else:
+    batch = [first]
+    data = { "puzzle": first["puzzle"], "solution": first["solution"] }
+
+  SUBMISSION_QUEUE["in_flight"] = True
+  handler = submission_handler(batch)
+  browser.ajax.post(
+    first["url"],
+    data=data,
+    oncomplete=handler,
+    timeout=SUBMISSION_TIMEOUT,
+    ontimeout=handler
+  )
+
+def submission_handler(batch):
+  """
+  Creates a handler for the server's response to uploading the given batch of
+  queue entries (see flush_submissions).
+  """
+
+  def handle_submission_response(req):
     """
-    Handles the server response for a posted solution. The response is expected
-    to be a JSON object with keys 'status' and 'reason', where 'status' should
-    be either 'valid' for success or 'invalid' for failure.
+    Handles the server response for uploaded solutions. Solutions that were
+    accepted (or rejected for good) are removed from the queue, and another
+    upload is scheduled if any are left, after a delay if something failed.
     """
-    nonlocal widget
-    status_div = widget["submission_status"]
-    failed = False
-    if (
-      req.status not in (200, 201)
-  and (req.status != 0 or not dpath.startswith("file://"))
-    ):
-      # Failure at the protocol level
-      failed = True
-      reason = reason_for(req.status)
-    else:
+    SUBMISSION_QUEUE["in_flight"] = False
+    results = None
+    reason = None
+    if req.status in (200, 201):
       try:
-        response = browser.window.JSON.parse(req.text)
-        if response.status != "valid":
-          failed = True
-          reason = response.reason
-        # otherwise failed stays False
+        response = parse_json(req.text)
+        # (a valid single solution gets a response without any reason)
+        logged_out = response.get("reason") == "not logged in"
+        if batch[0]["batch"] and response.get("status") == "valid":
+          results = response["results"]
+        elif not batch[0]["batch"] and not logged_out:
+          response["id"] = batch[0]["id"]
+          results = [response]
+        else:
+          reason = response.get("reason")
       except Exception as e:
         reason = format_error(trap_exception(e))
-        failed = True
+    elif req.status == 0:
+      reason = "no connection"
+    else:
+      reason = reason_for(req.status)
 
-    if failed:
-      remove_class(status_div, "active", "succeeded")
-      add_class(status_div, "failed")
+    retry = False
+    if results == None:
+      # The whole request failed
       if reason == "not logged in":
-        remedy = "Use the link at the top of the page to log in."
+        # Retrying can't help until they log in
+        SUBMISSION_QUEUE["paused"] = True
+        remedy = (
+          "Use the link at the top of the page to log in, then check your "
+        + "solution again to upload it."
+        )
       else:
-        remedy = "Try checking your solution again?"
-      status_div.innerHTML = (
-        "Failed to upload solution! Reason: {}. {}"
-      ).format(
-        reason,
-        remedy
-      )
+        retry = True
+        remedy = "We'll keep trying to upload it automatically."
+      for entry in batch:
+        notify_submission(
+          entry["id"],
+          "failed",
+          "Failed to upload solution! Reason: {}. {}".format(reason, remedy)
+        )
+
     else:
-      remove_class(status_div, "active", "failed")
-      add_class(status_div, "succeeded")
-      status_div.innerHTML = "Solution uploaded successfully."
+      answered = set()
+      for result in results:
+        sub_id = result.get("id")
+        if sub_id not in SUBMISSIONS:
+          continue
+        answered.add(sub_id)
+        if result.get("status") == "valid":
+          notify_submission(
+            sub_id,
+            "succeeded",
+            "Solution uploaded successfully."
+          )
+          SUBMITTED.add(sub_id)
+          forget_submission(sub_id)
+        elif result.get("retry"):
+          retry = True
+          notify_submission(
+            sub_id,
+            "failed",
+            (
+              "Failed to upload solution! Reason: {}. We'll keep trying to "
+            + "upload it automatically."
+            ).format(result.get("reason"))
+          )
+        else:
+          notify_submission(
+            sub_id,
+            "failed",
+            "Failed to upload solution! Reason: {}.".format(
+              result.get("reason")
+            )
+          )
+          forget_submission(sub_id)
+      if any(entry["id"] not in answered for entry in batch):
+        retry = True
+
+    if retry:
+      SUBMISSION_QUEUE["failures"] += 1
+      schedule_submission_flush(retry_delay(SUBMISSION_QUEUE["failures"]))
+    else:
+      SUBMISSION_QUEUE["failures"] = 0
+      if len(SUBMISSIONS) > 0:
+        schedule_submission_flush(0) # next batch
+
+  return handle_submission_response
+
+def store_submission(entry):
+  """
+  Saves a queue entry in IndexedDB (if it's open). Entries found while not
+  logged in aren't saved, since the server won't accept them and they
+  can't be credited to whoever logs in later.
+  """
+  db = SUBMISSION_QUEUE["db"]
+  if db == None or entry.get("user", "") == "":
+    return
+  try:
+    db.transaction(SUBMISSION_STORE, "readwrite").objectStore(
+      SUBMISSION_STORE
+    ).put(entry)
+  except Exception as e:
+    log("Unable to store queued solution:\n{}".format(
+      format_error(trap_exception(e))
+    ))
+
+def forget_submission(sub_id):
+  """
+  Removes a submission from the queue, including from IndexedDB.
+  """
+  SUBMISSIONS.pop(sub_id, None)
+  SUBMISSION_WIDGETS.pop(sub_id, None)
+  db = SUBMISSION_QUEUE["db"]
+  if db == None:
+    return
+  try:
+    db.transaction(SUBMISSION_STORE, "readwrite").objectStore(
+      SUBMISSION_STORE
+    ).delete(sub_id)
+  except Exception as e:
+    log("Unable to remove uploaded solution from storage:\n{}".format(
+      format_error(trap_exception(e))
+    ))
 
-  return handle_solution_feedback
+def setup_submission_queue():
+  """
+  Opens the IndexedDB database for the submission queue, loads any solutions
+  left over from earlier visits and starts uploading them. Also arranges for
+  uploads to resume whenever the browser comes back online. Without
+  IndexedDB, the queue still works, but only while the page stays open.
+  """
+  browser.window.addEventListener(
+    "online",
+    lambda ev: schedule_submission_flush(0)
+  )
+
+  if not hasattr(browser.window, "indexedDB"):
+    return
+
+  def upgrade(ev):
+    ev.target.result.createObjectStore(SUBMISSION_STORE, { "keyPath": "id" })
+
+  def opened(ev):
+    db = ev.target.result
+    SUBMISSION_QUEUE["db"] = db
+    # Save anything queued before the database was ready:
+    for entry in SUBMISSIONS.values():
+      store_submission(entry)
+    # Load anything left over from earlier visits:
+    request = db.transaction(SUBMISSION_STORE, "readonly").objectStore(
+      SUBMISSION_STORE
+    ).getAll()
+    request.addEventListener("success", loaded)
+
+  def loaded(ev):
+    user = current_username()
+    for entry in make_dict(ev.target.result):
+      if "user" not in entry:
+        # Queued before entries recorded their user, so there's no telling
+        # whose solution it is
+        forget_submission(entry["id"])
+      elif entry["user"] == user and entry["id"] not in SUBMISSIONS:
+        SUBMISSIONS[entry["id"]] = entry
+      # Otherwise it belongs to someone else, and waits for them to log in
+    if len(SUBMISSIONS) > 0:
+      schedule_submission_flush(0)
+
+  def failed(ev):
+    log("Unable to open the submission queue database.")
+
+  try:
+    request = browser.window.indexedDB.open(SUBMISSION_DB_NAME, 1)
+  except Exception as e:
+    log("Unable to open the submission queue database:\n{}".format(
+      format_error(trap_exception(e))
+    ))
+    return
+  request.addEventListener("upgradeneeded", upgrade)
+  request.addEventListener("success", opened)
+  request.addEventListener("error", failed)
+
+#--------------#
+# Widget State #
+#--------------#
+
+# Saved widget states (see capture_widget_state) keyed by puzzle ID. These are
+# also stored in localStorage (see state_storage_key), so that they survive
+# reloading the page.
+WIDGET_STATES = {}
+
+STATE_STORAGE_PREFIX = "procedural_state:"
+
+# Detached DOM elements of recently-used puzzles keyed by puzzle ID (most
+# recently used last), so that switching back to one of them doesn't have to
+# rebuild it. Each entry has "widget" and "elements" keys.
+DETACHED_WIDGETS = {}
+
+# Maximum number of entries in DETACHED_WIDGETS
+DETACHED_WIDGET_LIMIT = 3
+
+def puzzle_fingerprint(widget):
+  """
+  Returns a string that identifies the blocks of the given widget's puzzle, so
+  that a saved state can be checked against the current version of a puzzle.
+  This is computed once when the widget is set up (see setup_base_puzzle).
+  """
+  return browser.window.JSON.stringify(
+    [widget["code_blocks"], widget["given_blocks"]]
+  )
+
+def state_storage_key(key):
+  """
+  Returns the localStorage key for the saved state of the puzzle with the
+  given ID. The key includes the current username, so that people who share
+  a computer don't pick up each other's arrangements or solved status.
+  """
+  return "{}{}:{}".format(STATE_STORAGE_PREFIX, current_username(), key)
+
+def capture_widget_state(widget):
+  """
+  Returns a JSON-compatible dictionary recording the current state of the
+  given widget: the order of blocks in each bucket (by block ID; see
+  setup_base_puzzle), option selections, displayed test results, and solved
+  status.
+  """
+  return {
+    "fingerprint": widget["fingerprint"],
+    "source": [
+      block.__block_id__
+      for block in widget["source_bucket"].querySelectorAll(".code_block")
+    ],
+    "solution": [
+      block.__block_id__
+      for block in widget["soln_bucket"].querySelectorAll(".code_block")
+    ],
+    "options": dict(widget["option_values"]),
+    "solved": widget.get("solved", False),
+    "last_solution": widget.get("last_solution"),
+    "unsolved": has_class(widget["node"], "unsolved"),
+    "tests": capture_test_results(widget),
+  }
+
+def capture_test_results(widget):
+  """
+  Returns a JSON-compatible dictionary recording the test results currently
+  displayed by the given widget (see report_test_results).
+  """
+  result = {
+    "indicator": widget["test_indicator"].innerText,
+    "status": [],
+    "values": [],
+    "expected": [],
+  }
+  for tnode in widget.get("test_elements", []):
+    result["status"].append(
+      [
+        cls
+        for cls in ("passed", "failed", "stale")
+        if has_class(tnode, cls)
+      ]
+    )
+    result["values"].append(tnode.querySelector(".test_value").innerText)
+    result["expected"].append(tnode.querySelector(".test_expected").innerText)
+  return result
+
+def save_widget_state(widget):
+  """
+  Records the current state of the given widget in WIDGET_STATES and in
+  localStorage. Does nothing for puzzles without an ID.
+  """
+  key = widget.get("state_key")
+  if key == None:
+    return
+
+  state = capture_widget_state(widget)
+  WIDGET_STATES[key] = state
+  try:
+    browser.window.localStorage.setItem(
+      state_storage_key(key),
+      browser.window.JSON.stringify(state)
+    )
+  except Exception as e:
+    # storage may be full or disabled; the in-memory state still works
+    log("Unable to store widget state:\n{}".format(
+      format_error(trap_exception(e))
+    ))
+
+def load_widget_state(key):
+  """
+  Returns the saved state for the puzzle with the given ID, from memory or
+  from localStorage, or None if there isn't one.
+  """
+  if key == None:
+    return None
+  if key in WIDGET_STATES:
+    return WIDGET_STATES[key]
+
+  try:
+    stored = browser.window.localStorage.getItem(state_storage_key(key))
+    if stored == None:
+      return None
+    state = parse_json(stored)
+  except Exception as e:
+    log("Unable to load widget state:\n{}".format(
+      format_error(trap_exception(e))
+    ))
+    return None
+
+  WIDGET_STATES[key] = state
+  return state
+
+def restore_widget_state(widget, state):
+  """
+  Applies a saved state (see capture_widget_state) to a freshly set-up widget.
+  Returns False without changing anything if the state doesn't match the
+  widget's puzzle (e.g., because the puzzle has been edited since).
+  """
+  if state.get("fingerprint") != widget["fingerprint"]:
+    log("Ignoring saved state for changed puzzle '{}'.".format(
+      widget["state_key"]
+    ))
+    return False
+
+  blocks = {}
+  for bucket in widget["buckets"]:
+    for block in bucket.querySelectorAll(".code_block"):
+      blocks[block.__block_id__] = block
+  saved = state["source"] + state["solution"]
+  if sorted(saved) != sorted(blocks):
+    return False
+
+  # Re-arrange blocks (the empty slot at the top of each bucket stays put):
+  for bucket, ids in (
+    (widget["source_bucket"], state["source"]),
+    (widget["soln_bucket"], state["solution"]),
+  ):
+    for block_id in ids:
+      bucket.appendChild(blocks[block_id])
+
+  # Option selections (unrendered blocks pick these up when rendered):
+  for key in state["options"]:
+    if key in widget["option_values"]:
+      widget["option_values"][key] = state["options"][key]
+  for sel in widget["node"].querySelectorAll(".option_selector"):
+    sel.value = widget["option_values"][sel.getAttribute("data-options-key")]
+
+  # Solved status (without re-submitting the solution):
+  if state["solved"]:
+    widget["solved"] = True
+    widget["last_solution"] = state["last_solution"]
+    add_class(widget["node"], "solved")
+  if state["unsolved"]:
+    add_class(widget["node"], "unsolved")
+
+  # Test results:
+  tests = state["tests"]
+  widget["test_indicator"].innerText = tests["indicator"]
+  for i, tnode in enumerate(widget.get("test_elements", [])):
+    if i >= len(tests["status"]):
+      break
+    add_class(tnode, *tests["status"][i])
+    tnode.querySelector(".test_value").innerText = tests["values"][i]
+    tnode.querySelector(".test_expected").innerText = tests["expected"][i]
+
+  return True
+
+def detach_widget(widget):
+  """
+  Saves the state of the given widget and removes its elements from the page,
+  keeping them in DETACHED_WIDGETS so that reattach_widget can put them back
+  if the same puzzle is selected again. Widgets for puzzles without an ID are
+  just removed.
+  """
+  key = widget.get("state_key")
+  save_widget_state(widget)
+
+  elements = []
+  for name in (
+    "submission_status",
+    "instructions",
+    "source_bucket",
+    "soln_bucket",
+    "test_div"
+  ):
+    elt = widget.get(name)
+    if elt != None:
+      elements.append(elt)
+      if elt.parentNode != None:
+        elt.parentNode.removeChild(elt)
+
+  if key == None:
+    if widget.get("lazy_observer") != None:
+      widget["lazy_observer"].disconnect()
+    return
+
+  DETACHED_WIDGETS.pop(key, None)
+  DETACHED_WIDGETS[key] = { "widget": widget, "elements": elements }
+  while len(DETACHED_WIDGETS) > DETACHED_WIDGET_LIMIT:
+    # dictionaries are ordered, so this is the least-recently-used entry
+    oldest = DETACHED_WIDGETS.pop(next(iter(DETACHED_WIDGETS)))
+    if oldest["widget"].get("lazy_observer") != None:
+      oldest["widget"]["lazy_observer"].disconnect()
+
+def reattach_widget(node, puzzle):
+  """
+  If the given puzzle was recently detached from the given node (see
+  detach_widget), puts its elements back and returns True. Returns False if
+  the puzzle needs to be set up from scratch.
+  """
+  key = puzzle.get("id")
+  if key not in DETACHED_WIDGETS:
+    return False
+
+  entry = DETACHED_WIDGETS[key]
+  widget = entry["widget"]
+  if widget["puzzle"] is not puzzle or not widget["node"].isSameNode(node):
+    return False
+
+  del DETACHED_WIDGETS[key]
+  for elt in entry["elements"]:
+    node.appendChild(elt)
+  node.__widget__ = widget
+  if widget.get("solved"):
+    add_class(node, "solved")
+  if WIDGET_STATES.get(key, {}).get("unsolved"):
+    add_class(node, "unsolved")
+  return True
 
 #-----------------#
 # Setup functions #
@@ -1732,6 +2813,10 @@ def setup_widget(node, puzzle=None):
       subsequent input() calls will get empty strings. The `reset_input`
       function can be called within test cases to reset input outcomes back to
       the start of the provided input.
+    output_limit, output_size_limit (optional):
+      The maximum number of print() calls and characters of printed output to
+      record while checking a solution (see mkprint). Tests fail if output
+      had to be dropped.
     tests (optional):
       A list of test dictionaries, which determine whether the puzzle is solved
       or not. If no tests are given, any non-empty code that doesn't generate
@@ -1777,7 +2862,7 @@ def setup_widget(node, puzzle=None):
   if puzzle == None:
     if node.hasAttribute("data-puzzle"):
       try:
-        puzzle = browser.window.JSON.parse(node.getAttribute("data-puzzle"))
+        puzzle = parse_json(node.getAttribute("data-puzzle"))
       except Exception as e:
         error(
           "Malformed JSON in data-puzzle attribute:\n{}".format(
@@ -1795,16 +2880,14 @@ def setup_widget(node, puzzle=None):
 
 def add_drag_handlers(node):
   """
-  Adds drag event handlers to the given node.
+  Adds the delegated drag event handler (see handle_drag_event) to the given
+  widget node, unless it's already been added.
   """
-  # Set up event handlers on this widget
-  node.addEventListener("dragstart", drag_start, False)
-  node.addEventListener("dragend", drag_end, False)
-  node.addEventListener("dragover", drag_over, False)
-  node.addEventListener("dragenter", drag_enter, False)
-  node.addEventListener("dragenter", drag_enter, False)
-  node.addEventListener("dragleave", drag_leave, False)
-  node.addEventListener("drop", drag_drop, False)
+  if hasattr(node, "__drag_handlers__"):
+    return
+  node.__drag_handlers__ = True
+  for event_type in DRAG_HANDLERS:
+    node.addEventListener(event_type, handle_drag_event, False)
 
 def blocks_from_lines(code):
   """
@@ -1818,12 +2901,23 @@ def blocks_from_lines(code):
     )
   )
 
+# Puzzles with more blocks than this render them lazily as they scroll into
+# view (see add_code_block_to_bucket)
+LAZY_RENDER_THRESHOLD = 40
+
+# How far outside of the visible area blocks are rendered in advance
+LAZY_RENDER_MARGIN = "200px"
+
 def setup_base_puzzle(node, puzzle):
   """
   Sets up a basic two-column puzzle where you drag blocks from the left into
   blank space on the right. Note: current contents of the node are first
   entirely removed.
   """
+  # Set aside the old puzzle (see detach_widget):
+  if hasattr(node, "__widget__"):
+    detach_widget(node.__widget__)
+
   # Remove any old puzzle elements or loading divs:
   for old in node.querySelectorAll(".loading"):
     old.parentNode.removeChild(old)
@@ -1836,14 +2930,17 @@ def setup_base_puzzle(node, puzzle):
   for old in node.querySelectorAll(".submission_status"):
     old.parentNode.removeChild(old)
 
-  remove_class(node, "solved") # mark as no-longer-solved
-  # TODO: Remember widget states!
+  remove_class(node, "solved", "unsolved") # mark as no-longer-solved
 
   # Get puzzle or default:
   if puzzle == None:
     puzzle = DEFAULT_PUZZLE
     # (default instructions will be added below)
 
+  # Switching back to a recently-used puzzle just puts it back:
+  if reattach_widget(node, puzzle):
+    return
+
   # Add default instructions if they're missing:
   if "instructions" not in puzzle:
     if "tests" in puzzle:
@@ -1858,11 +2955,19 @@ def setup_base_puzzle(node, puzzle):
   else:
     submit_url = None
 
+  # URL for uploading several solutions at once (see flush_submissions):
+  if node.hasAttribute("data-submit-batches-to"):
+    submit_batch_url = node.getAttribute("data-submit-batches-to")
+  else:
+    submit_batch_url = None
+
   # Create the widget object:
   w = {
     "puzzle": puzzle,
     "submit_url": submit_url,
-    "node": node
+    "submit_batch_url": submit_batch_url,
+    "node": node,
+    "state_key": puzzle.get("id"), # see save_widget_state
   }
   node.__widget__ = w # attach it to the DOM
 
@@ -1873,6 +2978,8 @@ def setup_base_puzzle(node, puzzle):
   given_blocks = puzzle.get("given", [])
   if isinstance(given_blocks, str):
     given_blocks = blocks_from_lines(given_blocks)
+  else:
+    given_blocks = list(given_blocks) # don't edit the puzzle's list below
 
   free_given = [False]*len(given_blocks)
   for i, given in enumerate(given_blocks):
@@ -1880,12 +2987,37 @@ def setup_base_puzzle(node, puzzle):
       free_given[i] = True
       given_blocks[i] = given[2:]
 
-  options = puzzle.get("options", {})
+  # Each option key needs at least one value (the first is the default);
+  # report bad keys and leave their placeholders alone:
+  options = {}
+  for key, values in puzzle.get("options", {}).items():
+    if isinstance(values, list) and len(values) > 0:
+      options[key] = values
+    else:
+      error(
+        (
+          "Option '{}' of puzzle '{}' must be a non-empty list of values; "
+        + "ignoring it."
+        ).format(key, puzzle.get("id"))
+      )
 
   w["code_blocks"] = code_blocks
   w["given_blocks"] = given_blocks
+  w["fingerprint"] = puzzle_fingerprint(w) # see restore_widget_state
   w["free_given"] = free_given
-  w["options"] = make_dict(options)
+  w["options"] = options
+  # current value for each option key (see get_code_block_code):
+  w["option_values"] = { key: options[key][0] for key in options }
+
+  # For big puzzles, only render blocks as they scroll into view:
+  if (
+    len(code_blocks) + len(given_blocks) > LAZY_RENDER_THRESHOLD
+and hasattr(browser.window, "IntersectionObserver")
+  ):
+    w["lazy_observer"] = browser.window.IntersectionObserver.new(
+      lazy_render_callback,
+      { "rootMargin": LAZY_RENDER_MARGIN }
+    )
 
   # submission status div
   w["submission_status"] = browser.document.createElement("div")
@@ -1903,6 +3035,7 @@ def setup_base_puzzle(node, puzzle):
 
   # bucket for source blocks
   w["source_bucket"] = browser.document.createElement("div")
+  w["source_bucket"].__widget__ = w
   add_class(w["source_bucket"], "code_bucket", "code_source")
   node.appendChild(w["source_bucket"])
 
@@ -1919,14 +3052,19 @@ def setup_base_puzzle(node, puzzle):
   # page.
 
   # Add each code block to our source div:
-  for block in code_blocks:
+  for i, block in enumerate(code_blocks):
     add_code_block_to_bucket(w["source_bucket"], w["options"], block)
+    w["source_bucket"].lastChild.__block_id__ = "c{}".format(i)
 
   # bucket for solution blocks
   w["soln_bucket"] = browser.document.createElement("div")
+  w["soln_bucket"].__widget__ = w
   add_class(w["soln_bucket"], "code_bucket", "soln_list")
   node.appendChild(w["soln_bucket"])
 
+  # All drop targets are inside one of these (see set_drag_state):
+  w["buckets"] = [w["source_bucket"], w["soln_bucket"]]
+
   # Add empty slot at top to anchor dropping
   add_empty_slot_to_bucket(w["soln_bucket"])
   eslot = w["soln_bucket"].firstChild
@@ -1944,6 +3082,7 @@ def setup_base_puzzle(node, puzzle):
       block,
       given=not free_given[i]
     )
+    w["soln_bucket"].lastChild.__block_id__ = "g{}".format(i)
 
   # Create evaluate button in the instructions
   eb = browser.document.createElement("button")
@@ -1973,11 +3112,13 @@ def setup_base_puzzle(node, puzzle):
       len(puzzle["tests"])
     )
     w["test_div"].appendChild(w["test_indicator"])
+    # Expand tests once, so that checking doesn't have to:
+    w["tests"] = [full_test(test) for test in puzzle["tests"]]
+
     # Display tests:
     w["test_elements"] = []
     hidden_count = 0
-    for test in puzzle["tests"]:
-      test = full_test(test)
+    for test in w["tests"]:
       tnode = browser.document.createElement("div")
       add_class(tnode, "test_feedback")
       if test.get("hidden"):
@@ -2009,11 +3150,25 @@ def setup_base_puzzle(node, puzzle):
       w["test_elements"].append(tnode) # same order as tests
       add_class(texpr, "test_expr", "test_code")
       add_class(texpr, "language-python")
-      texpr.innerText = test["expression"]
+      texpr.innerHTML = highlight_html(test["expression"])
       texpr.__code__ = test["expression"]
-      browser.window.Prism.highlightElement(texpr)
       tnode.appendChild(texpr)
 
+      # Report a broken test expression once, when the puzzle is set up,
+      # instead of only when the student checks their solution:
+      try:
+        compile(test["expression"], "<test expression>", "eval")
+      except SyntaxError as e:
+        broken = trap_exception(e)
+        error(
+          "Syntax error in test '{}' for puzzle '{}':\n{}".format(
+            test["label"],
+            puzzle.get("id"),
+            format_error(broken)
+          )
+        )
+        attach_error_mesage_to_code(texpr, broken)
+
       # Expected label
       texp_label = browser.document.createElement("span")
       add_class(texp_label, "field_label")
@@ -2073,15 +3228,18 @@ def setup_base_puzzle(node, puzzle):
   # Add tests block to widget node:
   node.appendChild(w["test_div"])
 
+  # Pick up where the student left off last time:
+  state = load_widget_state(w["state_key"])
+  if state != None:
+    restore_widget_state(w, state)
+
 def full_test(test):
   """
   Converts a potentially abbreviated test into a full test.
   """
   if isinstance(test, dict):
     result = test
-  elif isinstance(test, javascript.JSObject):
-    result = make_dict(test)
-  elif isinstance(test, [list, tuple]):
+  elif isinstance(test, (list, tuple)):
     result = {
       "label": "Value of '{}'".format(test[0]),
       "expression": test[0],
@@ -2133,7 +3291,7 @@ def load_json(url, callback, fail_callback=None, params=None):
     ):
       try:
         # Using Python's json module here is horrifically slow
-        obj = browser.window.JSON.parse(req.text)
+        obj = parse_json(req.text)
       except Exception as e:
         error("Malformed JSON from '{}':\n{}".format(dpath, req.text))
         error(format_error(trap_exception(e)))
@@ -2265,7 +3423,7 @@ def receive_puzzle(puzzle, loaded, callback):
   Callback for loading a puzzle that receives a JSON object 'loaded' and
   updates the given puzzle dictionary.
   """
-  puzzle.update(make_dict(loaded))
+  puzzle.update(loaded)
   puzzle["loaded_id"] = puzzle["load_id"]
   del puzzle["load_id"] # so we don't try to load this puzzle again
   callback(puzzle)
@@ -2359,12 +3517,12 @@ def setup_selector(node, info=None):
       # TODO: Loading icon!
       load_json(
         node.getAttribute("data-categories"),
-        lambda info: setup_selector(node, make_dict(info))
+        lambda info: setup_selector(node, info)
       ) # call ourselves but take the other branch
       return
-    else: # default info:
+    else: # default info (copied, since we'll add to it):
       info = make_dict(DEFAULT_INFO)
-  else:
+  elif not isinstance(info, dict): # parse_json already gives us a dictionary
     info = make_dict(info)
 
   if "puzzles_url" not in info:
@@ -2427,6 +3585,9 @@ def init_procedural_widgets():
         LOADING_GIF_URL = child.src
     l.style.display = "none"
 
+  # Start uploading any solutions left over from an earlier visit:
+  setup_submission_queue()
+
   # Collect each selector:
   selectors = browser.document.querySelectorAll(".procedural_selector")
   for sel in selectors:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+
+Measures how big the ground program for the puzzle generator gets (and how
+long grounding and finding a first puzzle take) as max_lines grows, how
+quickly models are found and turned into puzzles, and how varied they are.
+"""
+
+import sys
+import time
+
+import clingo
+
+from runner import RUN, models_until
+
+USAGE = """\
+benchmark.py -h|--help
+benchmark.py [-l|--lines MIN..MAX] [-t|--timeout SECONDS]
+             [-m|--models N] [-r|--reseed N] [-e|--encoding FILE]...
+             [CLINGO_ARG]...
+
+For each value of max_lines from MIN to MAX (2..6 by default), grounds the
+generator encoding (gen.lp and vars.lp by default; use -e/--encoding to give
+other files, e.g., an older version to compare against) and then solves for
+up to N models (200 by default), with the solver configured as in run.lp
+(see configure_solver there). Prints one row per max_lines value with the
+number of ground rules and atoms, the number of solver variables and
+constraints, the grounding time, the time taken to find the first model ('-'
+if there wasn't one within the timeout, which is 60 seconds by default), the
+number of models found per second (not counting post-processing), the
+number of models per second that run.lp's Python code can turn into puzzles
+(not counting solving time; see observe_solutions in run.lp), and how many
+different first lines there are among the first 100 models (up to variable
+names and operand order; see canonical_key in run.lp). The last two columns
+are '-' for encodings whose models run.lp can't read, such as ones from
+before expressions were encoded as trees.
+
+Models from one solve call tend to share their first lines. With -r/--reseed,
+solving starts over with a fresh seed (see reseed_solver in run.lp) after
+every N models, which gives more varied puzzles but fewer of them per second;
+by default, all models come from a single solve call.
+
+Sizes are measured for a fresh clingo instance per row. Any extra arguments
+are passed on to clingo (e.g., -c max_value=50); max_lines is set by this
+script.
+
+Run this from the gen directory.
+"""
+
+# Program parts to ground (see run.lp), plus one step(t) part per line
+PARTS = [("gen", []), ("vars", [])]
+
+DEFAULT_ENCODING = ["gen.lp", "vars.lp"]
+
+# How many models (from the first one) to count different first lines in
+VARIETY_SAMPLE = 100
+
+COLUMNS = [
+  ("max_lines", "{:>9}"),
+  ("rules", "{:>10}"),
+  ("atoms", "{:>10}"),
+  ("vars", "{:>10}"),
+  ("constraints", "{:>11}"),
+  ("ground (s)", "{:>10}"),
+  ("first (s)", "{:>10}"),
+  ("solve (/s)", "{:>10}"),
+  ("post (/s)", "{:>10}"),
+  ("first lines", "{:>11}"),
+]
+
+def postprocess(model):
+  """
+  Does the same work for a model as observe_solutions in run.lp, apart from
+  duplicate detection and output. Returns the model's lines.
+  """
+  lines = RUN["concrete_lines_for"](model)
+  key = RUN["canonical_key"](lines)
+  tests = RUN["puzzle_tests"](lines)
+  if tests != None:
+    RUN["make_puzzle"](lines, key, tests)
+  return lines
+
+def measure(lines, encoding, clingo_args, timeout, models, reseed):
+  """
+  Grounds the given encoding with max_lines set to lines and solves for up
+  to the given number of models, starting a new solve call with a fresh
+  seed after every reseed models (unless reseed is 0). Returns a dictionary
+  of measurements (see COLUMNS).
+  """
+  ctl = clingo.Control(
+    ["--stats", "-c", "max_lines={}".format(lines)] + clingo_args
+  )
+  RUN["configure_solver"](ctl)
+  for filename in encoding:
+    ctl.load(filename)
+
+  start = time.time()
+  ctl.ground(
+    PARTS
+  + [("step", [clingo.Number(t)]) for t in range(1, lines + 1)]
+  )
+  grounded = time.time()
+
+  first = None
+  found = 0
+  post = 0
+  post_error = None
+  first_lines = set()
+  while found < models:
+    RUN["reseed_solver"](ctl)
+    batch = 0
+    with ctl.solve(yield_=True, async_=True) as handle:
+      for model in models_until(handle, grounded + timeout):
+        if first == None:
+          first = time.time() - grounded
+        found += 1
+        batch += 1
+        if post_error == None:
+          # Encodings from before expression trees (see -e) don't produce
+          # models that run.lp can read, so they just don't get a
+          # post-processing rate
+          began = time.perf_counter()
+          try:
+            model_lines = postprocess(model)
+          except Exception as e:
+            post_error = e
+          post += time.perf_counter() - began
+          if post_error == None and found <= VARIETY_SAMPLE:
+            first_lines.add(RUN["canonical_key"](model_lines[:1]))
+        if found >= models or batch == reseed:
+          break
+    # Without reseeding, or if models ran out or time is up, we're done
+    if batch != reseed:
+      break
+  solving = time.time() - grounded - post
+
+  stats = ctl.statistics["problem"]
+  return {
+    "max_lines": lines,
+    "rules": int(stats["lp"]["rules"]),
+    "atoms": int(stats["lp"]["atoms"]),
+    "vars": int(stats["generator"]["vars"]),
+    "constraints": int(stats["generator"]["constraints"]),
+    "ground (s)": "{:.2f}".format(grounded - start),
+    "first (s)": "{:.2f}".format(first) if first != None else '-',
+    "solve (/s)": "{:.0f}".format(found / solving) if found else '-',
+    "post (/s)": (
+      "{:.0f}".format(found / post)
+      if found and post_error == None
+      else '-'
+    ),
+    "first lines": (
+      "{}/{}".format(len(first_lines), min(found, VARIETY_SAMPLE))
+      if found and post_error == None
+      else '-'
+    ),
+    "post_error": post_error,
+  }
+
+def main(first, last, encoding, clingo_args, timeout, models, reseed):
+  """
+  Prints a table of measurements for each max_lines value from first to last.
+  """
+  print(' '.join(fmt.format(name) for name, fmt in COLUMNS))
+  warned = False
+  for lines in range(first, last + 1):
+    row = measure(lines, encoding, clingo_args, timeout, models, reseed)
+    print(' '.join(fmt.format(row[name]) for name, fmt in COLUMNS))
+    sys.stdout.flush()
+    if row["post_error"] != None and not warned:
+      print(
+        "Can't turn this encoding's models into puzzles ({}: {}).".format(
+          type(row["post_error"]).__name__,
+          row["post_error"]
+        ),
+        file=sys.stderr
+      )
+      warned = True
+
+if __name__ == "__main__":
+  if '-h' in sys.argv or '--help' in sys.argv:
+    print(USAGE)
+    exit()
+
+  first, last = 2, 6
+  timeout = 60
+  models = 200
+  reseed = 0
+  encoding = []
+  clingo_args = []
+  args = sys.argv[1:]
+  try:
+    while args:
+      arg = args.pop(0)
+      if arg in ('-l', '--lines'):
+        first, last = [int(x) for x in args.pop(0).split('..')]
+      elif arg in ('-t', '--timeout'):
+        timeout = float(args.pop(0))
+      elif arg in ('-m', '--models'):
+        models = int(args.pop(0))
+      elif arg in ('-r', '--reseed'):
+        reseed = int(args.pop(0))
+      elif arg in ('-e', '--encoding'):
+        encoding.append(args.pop(0))
+      else:
+        clingo_args.append(arg)
+  except (IndexError, ValueError):
+    print(USAGE, file=sys.stderr)
+    exit(1)
+
+  main(
+    first,
+    last,
+    encoding or DEFAULT_ENCODING,
+    clingo_args,
+    timeout,
+    models,
+    reseed
+  )
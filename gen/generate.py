@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+generate.py
+
+Runs several clingo puzzle generators (see run.lp) in parallel with different
+seeds, and merges their output into a single stream of unique puzzles.
+"""
+
+import os
+import sys
+import json
+import queue
+import random
+import threading
+import subprocess
+
+USAGE = """\
+generate.py -h|--help
+generate.py [-j|--jobs N] [-s|--seed SEED] [-n|--limit COUNT]
+            [-o|--output FILE] [--array] [CLINGO_ARG]...
+
+Launches N clingo processes (one per CPU core by default) running run.lp in
+streaming (JSON Lines) mode, each with its own seed derived from SEED (the
+contents of the 'seed' file by default; see Makefile). Puzzles from all
+processes are merged into FILE (stdout by default) as they're found, one JSON
+object per line, skipping puzzles that have already been produced (compared
+by their canonical keys; see canonical_key in run.lp). Use --array to write a
+single JSON array at the end instead (like run.lp's default output mode).
+
+Generation stops once COUNT unique puzzles have been found (if a limit is
+given), when all processes finish, or on ^C; puzzles found up to that point
+are kept. Any extra arguments are passed on to clingo (e.g., -c max_lines=5).
+
+Run this from the gen directory.
+"""
+
+# Multiplier for deriving per-process seeds from the base seed (clingo seeds
+# must fit in 32 bits)
+SEED_STRIDE = 2654435761
+
+# In JSON Lines mode, output is flushed after this many puzzles
+FLUSH_EVERY = 100
+
+def derived_seeds(base, count):
+  """
+  Returns a list of count distinct clingo seeds derived from the given base
+  seed.
+  """
+  return [(base + i * SEED_STRIDE) % (2**32 - 1) for i in range(count)]
+
+def launch(seed, clingo_args):
+  """
+  Starts a clingo generator process with the given seed in JSON Lines mode
+  and returns the Popen object. The process's progress messages (on stderr)
+  are discarded.
+  """
+  return subprocess.Popen(
+    [
+      "clingo",
+      "--outf=3",
+      "--seed={}".format(seed),
+      "-c", "output=jsonl",
+    ]
+  + clingo_args
+  + ["run.lp"],
+    stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL,
+    universal_newlines=True,
+    bufsize=1
+  )
+
+def pump(proc, lines):
+  """
+  Reads lines from the given process's stdout and puts them into the given
+  queue, followed by None once the process's output ends. Meant to run in its
+  own thread.
+  """
+  for line in proc.stdout:
+    lines.put(line)
+  lines.put(None)
+
+def puzzle_key(puzzle):
+  """
+  Returns the key used to detect duplicate puzzles: the canonical key from
+  run.lp (which ignores variable names and operand order) if there is one, or
+  otherwise the code itself.
+  """
+  return puzzle.get("key", puzzle["code"])
+
+def merge(procs, out, limit=None, array=False):
+  """
+  Merges puzzles from the given generator processes, writing each unique one
+  to the given output stream. Returns the number of unique puzzles written
+  and the number of duplicates skipped.
+  """
+  lines = queue.Queue(maxsize=10000)
+  for proc in procs:
+    threading.Thread(target=pump, args=(proc, lines), daemon=True).start()
+
+  seen = set()
+  puzzles = []
+  duplicates = 0
+  running = len(procs)
+  try:
+    while running > 0 and (limit == None or len(seen) < limit):
+      line = lines.get()
+      if line == None:
+        running -= 1
+        continue
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        puzzle = json.loads(line)
+      except ValueError:
+        # e.g., a partial line from a process that was killed
+        continue
+
+      key = puzzle_key(puzzle)
+      if key in seen:
+        duplicates += 1
+        continue
+      seen.add(key)
+
+      if array:
+        puzzles.append(puzzle)
+      else:
+        out.write(json.dumps(puzzle) + '\n')
+        if len(seen) % FLUSH_EVERY == 0:
+          out.flush()
+      sys.stderr.write(
+        "Found {} unique puzzles ({} duplicates) so far...\r".format(
+          len(seen),
+          duplicates
+        )
+      )
+  except KeyboardInterrupt:
+    pass
+
+  if array:
+    out.write(json.dumps(puzzles))
+  out.flush()
+  return len(seen), duplicates
+
+def main(jobs, seed, limit, output, array, clingo_args):
+  """
+  Launches the generator processes, merges their output, and stops them all
+  once merging is done.
+  """
+  seeds = derived_seeds(seed, jobs)
+  procs = [launch(s, clingo_args) for s in seeds]
+  sys.stderr.write(
+    "Started {} generators with seeds: {}\n".format(
+      jobs,
+      ', '.join(str(s) for s in seeds)
+    )
+  )
+  sys.stderr.write("Use ^C at any time to stop generating.\n")
+  sys.stderr.flush()
+
+  if output == None:
+    found, duplicates = merge(procs, sys.stdout, limit, array)
+  else:
+    with open(output, 'w') as fout:
+      found, duplicates = merge(procs, fout, limit, array)
+
+  for proc in procs:
+    if proc.poll() == None:
+      proc.terminate()
+  for proc in procs:
+    try:
+      proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+      proc.kill()
+
+  sys.stderr.write(
+    "\nFound {} unique puzzles in total ({} duplicates skipped).\n".format(
+      found,
+      duplicates
+    )
+  )
+
+if __name__ == "__main__":
+  if '-h' in sys.argv or '--help' in sys.argv:
+    print(USAGE)
+    exit()
+
+  jobs = os.cpu_count() or 1
+  seed = None
+  limit = None
+  output = None
+  array = False
+  clingo_args = []
+  args = sys.argv[1:]
+  try:
+    while args:
+      arg = args.pop(0)
+      if arg in ('-j', '--jobs'):
+        jobs = int(args.pop(0))
+      elif arg in ('-s', '--seed'):
+        seed = int(args.pop(0))
+      elif arg in ('-n', '--limit'):
+        limit = int(args.pop(0))
+      elif arg in ('-o', '--output'):
+        output = args.pop(0)
+      elif arg == '--array':
+        array = True
+      else:
+        clingo_args.append(arg)
+  except (IndexError, ValueError):
+    print(USAGE, file=sys.stderr)
+    exit(1)
+
+  if seed == None:
+    if os.path.exists("seed"):
+      with open("seed", 'r') as fin:
+        seed = int(fin.read().strip())
+    else:
+      seed = random.randrange(2**32 - 1)
+
+  main(jobs, seed, limit, output, array, clingo_args)
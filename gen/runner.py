@@ -0,0 +1,46 @@
+"""
+runner.py
+
+Shared pieces for Python scripts that drive the generator through clingo's
+Python API (see serve.py and benchmark.py): the functions from run.lp's
+embedded script, and a way to pull models from an asynchronous solve until a
+deadline.
+"""
+
+import os
+import time
+
+# run.lp lives next to this file
+RUN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.lp")
+
+def load_run_script(filename=RUN_SCRIPT):
+  """
+  Returns a dictionary containing the functions and globals defined by the
+  Python script embedded in run.lp, so that puzzles are converted, checked,
+  and deduplicated exactly the same way as in batch generation.
+  """
+  with open(filename, 'r') as fin:
+    text = fin.read()
+  start = text.index("#script(python)") + len("#script(python)")
+  end = text.index("#end.", start)
+  result = { "__name__": "run" }
+  exec(text[start:end], result)
+  return result
+
+RUN = load_run_script()
+
+def models_until(handle, deadline):
+  """
+  Yields models from the given asynchronous solve handle until there are no
+  more, or until the deadline (a time.time() value) passes, in which case
+  solving is cancelled.
+  """
+  while True:
+    handle.resume()
+    if not handle.wait(max(0, deadline - time.time())):
+      handle.cancel()
+      return
+    model = handle.model()
+    if model == None:
+      return
+    yield model
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+serve.py
+
+A long-running puzzle generator service. Keeps a grounded clingo program in
+memory for each puzzle genre, and answers HTTP requests for puzzles by
+solving with assumptions (line counts) and external atoms (allowed
+operators) instead of grounding from scratch each time. Puzzles are streamed
+back as JSON Lines as they're found.
+"""
+
+import sys
+import json
+import time
+import random
+import threading
+import urllib.parse
+import http.server
+
+import clingo
+
+from runner import RUN, models_until
+
+USAGE = """\
+serve.py -h|--help
+serve.py [-p|--port PORT] [--host HOST] [-s|--seed SEED]
+         [--min-lines N] [--max-lines N] [CLINGO_ARG]...
+
+Starts a puzzle generator service on HOST:PORT (127.0.0.1:8765 by default).
+Each genre's program is grounded when the service starts, and lines are
+grounded as requests need them (up to --max-lines, 6 by default). Any extra
+arguments are passed on to clingo (e.g., -c max_value=50).
+
+Requests:
+
+  GET /puzzles?genre=vars&count=20&lines=4-5&operators=plus,minus,times
+
+    Streams up to count (default 10) new puzzles from the given genre
+    (default vars) as JSON Lines, in the same format as run.lp's jsonl
+    output mode. lines is a line count or range (default: any count from
+    --min-lines to --max-lines), and operators is a comma-separated list of
+    the operators that may be used (default: all of them). A timeout (in
+    seconds; default 60) can also be given, after which the response ends
+    even if fewer than count puzzles have been found. A puzzle is never
+    handed out twice by the same service.
+
+  GET /genres
+
+    Returns a JSON object mapping each genre to its line count range and
+    operators.
+
+Run this from the gen directory.
+"""
+
+# Genres: each maps to the file and program part that add its rules to gen.lp
+# (see run.lp)
+GENRES = {
+  "vars": ("vars.lp", "vars"),
+}
+
+DEFAULT_COUNT = 10
+MAX_COUNT = 1000
+DEFAULT_TIMEOUT = 60
+MAX_TIMEOUT = 600
+
+def warm_genre(genre, seed, clingo_args):
+  """
+  Creates a clingo control object for the given genre, configured like
+  run.lp's main, and grounds the genre's program apart from its lines.
+  Returns the genre's state, as a dictionary.
+  """
+  filename, part = GENRES[genre]
+  ctl = clingo.Control(["--seed={}".format(seed)] + clingo_args)
+  RUN["configure_solver"](ctl)
+  ctl.load("gen.lp")
+  ctl.load(filename)
+  ctl.ground([("gen", []), (part, [])])
+
+  operators = set()
+  for sig in ("unop", "binop", "asgop"):
+    for atom in ctl.symbolic_atoms.by_signature(sig, 1):
+      operators.add(atom.symbol.arguments[0].name)
+
+  return {
+    "genre": genre,
+    "control": ctl,
+    "lock": threading.Lock(),
+    "grounded": 0, # number of lines grounded so far
+    "min_lines": RUN["number_const"](ctl, "min_lines", 2),
+    "max_lines": RUN["number_const"](ctl, "max_lines", 3),
+    "operators": sorted(operators),
+    "seen": RUN["new_seen"](),
+  }
+
+def ground_lines(state, last):
+  """
+  Makes sure that lines up to last are grounded for the given genre.
+  """
+  if last > state["grounded"]:
+    state["control"].ground(RUN["step_parts"](state["grounded"] + 1, last))
+    state["grounded"] = last
+
+def generate(state, count, first, last, operators, timeout, out):
+  """
+  Writes up to count new puzzles with between first and last lines, using
+  only the given operators, to the given output stream as JSON Lines.
+  Returns the number of puzzles written.
+  """
+  ctl = state["control"]
+  assumptions = [
+    (clingo.Function("line_count", [clingo.Number(n)]), False)
+    for n in range(state["min_lines"], state["max_lines"] + 1)
+    if not first <= n <= last
+  ]
+
+  with state["lock"]:
+    ground_lines(state, last)
+    # External atoms are fixed rather than assumed, since an external that
+    # hasn't been assigned is false and can't be assumed true.
+    for op in state["operators"]:
+      ctl.assign_external(
+        clingo.Function("forbid", [clingo.Function(op, [])]),
+        op not in operators
+      )
+    observer = RUN["new_observer"]("jsonl", out)
+    observer["seen"] = state["seen"] # no repeats across requests
+    RUN["reseed_solver"](ctl) # don't pick up where the last request left off
+    deadline = time.time() + timeout
+    with ctl.solve(
+      yield_=True,
+      async_=True,
+      assumptions=assumptions
+    ) as handle:
+      found = RUN["observe_solutions"](
+        models_until(handle, deadline),
+        observer,
+        count
+      )
+    out.flush()
+  return found
+
+def parse_request(query, states):
+  """
+  Converts /puzzles query parameters into arguments for generate. Raises a
+  ValueError with a message for the client if they're invalid.
+  """
+  params = {
+    key: values[-1]
+    for key, values in urllib.parse.parse_qs(query).items()
+  }
+  genre = params.get("genre", "vars")
+  if genre not in states:
+    raise ValueError("Unknown genre '{}'.".format(genre))
+  state = states[genre]
+
+  count = int(params.get("count", DEFAULT_COUNT))
+  if not 1 <= count <= MAX_COUNT:
+    raise ValueError("count must be between 1 and {}.".format(MAX_COUNT))
+
+  if "lines" in params:
+    bounds = params["lines"].split('-')
+    first, last = int(bounds[0]), int(bounds[-1])
+  else:
+    first, last = state["min_lines"], state["max_lines"]
+  if not state["min_lines"] <= first <= last <= state["max_lines"]:
+    raise ValueError(
+      "lines must be within {}-{}.".format(
+        state["min_lines"],
+        state["max_lines"]
+      )
+    )
+
+  if "operators" in params:
+    operators = [op for op in params["operators"].split(',') if op]
+    unknown = [op for op in operators if op not in state["operators"]]
+    if unknown:
+      raise ValueError("Unknown operators: {}.".format(', '.join(unknown)))
+  else:
+    operators = state["operators"]
+
+  timeout = float(params.get("timeout", DEFAULT_TIMEOUT))
+  if not 0 < timeout <= MAX_TIMEOUT:
+    raise ValueError("timeout must be at most {}.".format(MAX_TIMEOUT))
+
+  return state, count, first, last, operators, timeout
+
+class PuzzleRequestHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Handles requests to the service (see USAGE). The server's 'states'
+  attribute maps genres to their states (see warm_genre).
+  """
+  def send_json(self, status, obj):
+    body = json.dumps(obj).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    states = self.server.states
+    if url.path == "/genres":
+      self.send_json(
+        200,
+        {
+          genre: {
+            "lines": [state["min_lines"], state["max_lines"]],
+            "operators": state["operators"],
+          }
+          for genre, state in states.items()
+        }
+      )
+    elif url.path == "/puzzles":
+      try:
+        args = parse_request(url.query, states)
+      except ValueError as e:
+        self.send_json(400, { "error": str(e) })
+        return
+      self.send_response(200)
+      self.send_header("Content-Type", "application/x-ndjson")
+      self.end_headers()
+      out = self.wfile
+      stream = WriteText(out)
+      try:
+        generate(*args, stream)
+      except (BrokenPipeError, ConnectionResetError):
+        pass # client went away; solving was stopped by the with block
+      self.close_connection = True
+    else:
+      self.send_json(404, { "error": "Not found." })
+
+class WriteText:
+  """
+  Wraps a binary stream so that observe_solutions can write text to it.
+  """
+  def __init__(self, stream):
+    self.stream = stream
+
+  def write(self, text):
+    self.stream.write(text.encode("utf-8"))
+
+  def flush(self):
+    self.stream.flush()
+
+def main(host, port, seed, clingo_args):
+  """
+  Grounds each genre's program, then serves requests until interrupted.
+  """
+  random.seed(seed) # for variable names (see run.lp)
+  states = {}
+  for genre in GENRES:
+    start = time.time()
+    states[genre] = warm_genre(genre, seed, clingo_args)
+    sys.stderr.write(
+      "Grounded '{}' in {:.2f}s.\n".format(genre, time.time() - start)
+    )
+
+  server = http.server.ThreadingHTTPServer((host, port), PuzzleRequestHandler)
+  server.states = states
+  sys.stderr.write("Serving puzzles on http://{}:{}/\n".format(host, port))
+  sys.stderr.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+
+if __name__ == "__main__":
+  if '-h' in sys.argv or '--help' in sys.argv:
+    print(USAGE)
+    exit()
+
+  host = "127.0.0.1"
+  port = 8765
+  seed = random.randrange(2**32 - 1)
+  min_lines = 2
+  max_lines = 6
+  clingo_args = []
+  args = sys.argv[1:]
+  try:
+    while args:
+      arg = args.pop(0)
+      if arg in ('-p', '--port'):
+        port = int(args.pop(0))
+      elif arg == '--host':
+        host = args.pop(0)
+      elif arg in ('-s', '--seed'):
+        seed = int(args.pop(0))
+      elif arg == '--min-lines':
+        min_lines = int(args.pop(0))
+      elif arg == '--max-lines':
+        max_lines = int(args.pop(0))
+      else:
+        clingo_args.append(arg)
+  except (IndexError, ValueError):
+    print(USAGE, file=sys.stderr)
+    exit(1)
+
+  clingo_args = [
+    "-c", "min_lines={}".format(min_lines),
+    "-c", "max_lines={}".format(max_lines),
+  ] + clingo_args
+
+  main(host, port, seed, clingo_args)